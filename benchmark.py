@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+	PromptPack benchmark
+
+	Generates synthetic projects and times promptpack's entry points headlessly.
+	Results are written as JSON so they can be compared between commits:
+
+		python benchmark.py --files 2000 --depth 5 -o before.json
+		python benchmark.py --files 2000 --depth 5 -o after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import curses
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from pathlib import Path
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import promptpack as pp
+
+
+class FakeScreen:
+    """Minimal stand-in for a curses window so the TUI can be redrawn headlessly"""
+    def __init__(self, height=50, width=160, keys=None):
+        self.height = height
+        self.width = width
+        self.keys = list(keys or [])
+        self.writes = 0
+        self.bytes_written = 0
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        if y >= self.height or x + len(text) > self.width:
+            raise curses.error("addstr() returned ERR")
+        self.writes += 1
+        self.bytes_written += len(text)
+
+    def getch(self):
+        return self.keys.pop(0) if self.keys else ord('q')
+
+    def clear(self):
+        pass
+
+    def erase(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def timeout(self, delay):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+
+def install_fake_curses():
+    """color_pair() kräver initscr(), så ersätt den med en ren bitförskjutning"""
+    curses.color_pair = lambda n: n << 8
+    curses.curs_set = lambda visibility: 0
+
+
+def sample_size(rng, distribution, mean_size):
+    if distribution == 'fixed':
+        return mean_size
+    if distribution == 'uniform':
+        return rng.randint(1, mean_size * 2)
+    # lognormal, scaled so the expected value is mean_size
+    sigma = 1.0
+    mu = max(0.0, math.log(mean_size) - sigma ** 2 / 2)
+    return max(1, int(rng.lognormvariate(mu, sigma)))
+
+
+def generate_text(file_idx, size):
+    """Pythonlik källkod med unika funktioner som patchar och ctags kan hitta"""
+    parts = [f'"""Synthetic module {file_idx}"""\n\n']
+    written = len(parts[0])
+    funcs = []
+    n = 0
+    while written < size:
+        name = f"func_{file_idx}_{n}"
+        block = (
+            f"def {name}(arg):\n"
+            f"    value = arg * {n}\n"
+            f"    return value + {n}\n"
+            f"\n\n"
+        )
+        parts.append(block)
+        funcs.append(name)
+        written += len(block)
+        n += 1
+    return ''.join(parts), funcs
+
+
+def generate_repo(root, files=500, depth=4, dirs_per_level=4, distribution='lognormal',
+                  mean_size=4096, binary_ratio=0.1, seed=0):
+    """
+    Skapa ett syntetiskt projekt under root
+    Returns: list of (path, [function names]) for the text files
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    text_files = []
+
+    for idx in range(files):
+        levels = rng.randint(0, depth)
+        directory = root.joinpath(*(f"pkg{rng.randrange(dirs_per_level)}" for _ in range(levels)))
+        directory.mkdir(parents=True, exist_ok=True)
+        size = sample_size(rng, distribution, mean_size)
+
+        if rng.random() < binary_ratio:
+            data = bytes(rng.getrandbits(8) for _ in range(min(size, 4096))) + b'\x00'
+            (directory / f"blob_{idx}.bin").write_bytes(data)
+            continue
+
+        path = directory / f"module_{idx}.py"
+        content, funcs = generate_text(idx, size)
+        path.write_text(content, encoding='utf-8')
+        text_files.append((path, funcs))
+
+    return text_files
+
+
+def generate_patch_history(root, text_files, length, seed=0):
+    """Skriv en syntetisk patch.json med length poster"""
+    rng = random.Random(seed)
+    history = []
+    for patch_id in range(1, length + 1):
+        path, funcs = rng.choice(text_files)
+        name = rng.choice(funcs) if funcs else 'none'
+        history.append({
+            'id': patch_id,
+            'timestamp': datetime.now().isoformat(),
+            'filepath': str(Path(path).resolve()),
+            'description': f"Synthetic patch {patch_id}",
+            'old_text': f"def {name}(arg):\n",
+            'new_text': f"def {name}(arg):\n",
+            'applied': rng.random() < 0.8
+        })
+    with open(Path(root) / 'patch.json', 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=2, ensure_ascii=False)
+    return history
+
+
+def time_call(fn, repeat, setup=None):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        'runs': repeat,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'max': max(samples),
+    }, result
+
+
+def expand_all(node):
+    if node.is_dir:
+        node.expanded = True
+        for child in node.children:
+            expand_all(child)
+
+
+def mark_fraction(root, fraction, seed=0):
+    rng = random.Random(seed)
+    def visit(node):
+        if node.is_dir:
+            for child in node.children:
+                visit(child)
+        elif rng.random() < fraction:
+            node.marked = True
+    visit(root)
+
+
+def git_revision():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True,
+            cwd=Path(__file__).resolve().parent
+        )
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except (subprocess.SubprocessError, FileNotFoundError):
+        pass
+    return None
+
+
+def run_benchmarks(args, repo):
+    results = {}
+    text_files = generate_repo(
+        repo, files=args.files, depth=args.depth, dirs_per_level=args.dirs,
+        distribution=args.distribution, mean_size=args.mean_size,
+        binary_ratio=args.binary_ratio, seed=args.seed
+    )
+    generate_patch_history(repo, text_files, args.history, seed=args.seed)
+
+    # Keep the user's real selection file out of reach
+    pp.PROMPTPACK_FILE = Path(repo) / '.promptpack'
+    os.chdir(repo)
+    install_fake_curses()
+
+    stats, root = time_call(lambda: pp.build_tree('.', load_marks=False), args.repeat)
+    results['build_tree'] = stats
+
+    expand_all(root)
+    mark_fraction(root, args.mark_ratio, seed=args.seed)
+    marked_files = pp.get_marked_files(root)
+    visible = len(pp.flatten_visible_tree(root))
+
+    screen = FakeScreen(height=args.height, width=args.width)
+    positions = iter(range(10 ** 9))
+    def redraw():
+        selected = next(positions) % max(1, visible)
+        scroll = max(0, selected - (args.height - 3))
+        pp.draw_tree(screen, root, selected, scroll)
+    results['draw_tree'] = time_call(redraw, args.repeat)[0]
+
+    results['calculate_total_tokens'] = time_call(
+        lambda: pp.calculate_total_tokens(marked_files), args.repeat)[0]
+
+    results['create_code_file'] = time_call(lambda: pp.create_code_file(root), args.repeat)[0]
+
+    if shutil.which('ctags'):
+        results['create_ctags_file'] = time_call(lambda: pp.create_ctags_file(root), args.repeat)[0]
+    else:
+        results['create_ctags_file'] = {'skipped': 'ctags not installed'}
+
+    targets = [(path, name) for path, funcs in text_files for name in funcs]
+    random.Random(args.seed).shuffle(targets)
+    cursor = iter(range(10 ** 9))
+    def patch_batch():
+        for _ in range(args.patches):
+            k = next(cursor)
+            path, name = targets[k % len(targets)]
+            # Every other patch uses wrong indentation to exercise flexible whitespace matching
+            indent = "  " if k % 2 else "    "
+            direction = (k // len(targets)) % 2
+            old_op, new_op = ('+', '-') if direction == 0 else ('-', '+')
+            old_text = f"def {name}(arg):\n{indent}value = arg"
+            n = name.rsplit('_', 1)[1]
+            pp.apply_patch(
+                path, f"Bench patch {k}",
+                f"{old_text} * {n}\n{indent}return value {old_op} {n}\n",
+                f"def {name}(arg):\n    value = arg * {n}\n    return value {new_op} {n}\n"
+            )
+    if targets and args.patches:
+        results['apply_patch'] = time_call(patch_batch, args.repeat)[0]
+        results['apply_patch']['patches_per_run'] = args.patches
+
+    return results, {
+        'text_files': len(text_files),
+        'marked_files': len(marked_files),
+        'visible_nodes': visible,
+    }
+
+
+def _stress_worker(task):
+    """Ett arbetarprocess: varannan patch i en egen fil, varannan i den delade filen"""
+    repo, worker, count = task
+    os.chdir(repo)
+    failures = []
+    for i in range(count):
+        target = f"worker_{worker}.py" if i % 2 else "shared.py"
+        success, message = pp.apply_patch(
+            target, f"Stress {worker} {i}",
+            f"slot_{worker}_{i} = 0\n", f"slot_{worker}_{i} = 1\n"
+        )
+        if not success:
+            failures.append(message)
+    return failures
+
+
+def stress_patches(repo, workers, count):
+    """
+    Apply patches from several processes at once and check that no update was lost
+    Returns: list of problems (empty when everything is consistent)
+    """
+    repo = Path(repo)
+    repo.mkdir(parents=True, exist_ok=True)
+    slots = {w: [f"slot_{w}_{i} = 0\n" for i in range(count)] for w in range(workers)}
+    (repo / 'shared.py').write_text(''.join(line for w in range(workers) for i, line in enumerate(slots[w]) if i % 2 == 0))
+    for w in range(workers):
+        (repo / f"worker_{w}.py").write_text(''.join(line for i, line in enumerate(slots[w]) if i % 2))
+
+    with multiprocessing.Pool(workers) as pool:
+        failures = [f for result in pool.map(_stress_worker, [(str(repo), w, count) for w in range(workers)]) for f in result]
+
+    problems = list(failures)
+    with open(repo / 'patch.json', 'r', encoding='utf-8') as f:
+        history = json.load(f)
+    ids = [p['id'] for p in history]
+    if len(history) != workers * count:
+        problems.append(f"patch.json has {len(history)} entries, expected {workers * count}")
+    if sorted(ids) != list(range(1, len(ids) + 1)):
+        problems.append("patch ids are not unique and contiguous")
+    for path in [repo / 'shared.py'] + [repo / f"worker_{w}.py" for w in range(workers)]:
+        lost = path.read_text().count(' = 0\n')
+        if lost:
+            problems.append(f"{path.name}: {lost} update(s) lost")
+    lines = (repo / 'clipboard.tmp').read_text().count('\n')
+    if lines != workers * count:
+        problems.append(f"clipboard.tmp has {lines} lines, expected {workers * count}")
+    return problems
+
+
+def compare(base, current, threshold):
+    """Skriv ut en jämförelsetabell; returnerar antalet regressioner"""
+    regressions = 0
+    print(f"{'Benchmark':<24} {'Base':>10} {'Current':>10} {'Ratio':>7}")
+    for name, stats in current['results'].items():
+        old = base.get('results', {}).get(name)
+        if 'median' not in stats or not old or 'median' not in old:
+            print(f"{name:<24} {'-':>10} {'-':>10} {'-':>7}")
+            continue
+        ratio = stats['median'] / old['median'] if old['median'] else float('inf')
+        status = '🔴' if ratio > threshold else '✅'
+        if ratio > threshold:
+            regressions += 1
+        print(f"{name:<24} {old['median'] * 1000:>8.1f}ms {stats['median'] * 1000:>8.1f}ms {ratio:>6.2f}x {status}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark promptpack against a synthetic project')
+    parser.add_argument('--files', type=int, default=500, help='Number of files to generate')
+    parser.add_argument('--depth', type=int, default=4, help='Maximum directory depth')
+    parser.add_argument('--dirs', type=int, default=4, help='Directories per level')
+    parser.add_argument('--distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal',
+                        help='File size distribution')
+    parser.add_argument('--mean-size', type=int, default=4096, help='Mean file size in bytes')
+    parser.add_argument('--binary-ratio', type=float, default=0.1, help='Fraction of binary files')
+    parser.add_argument('--history', type=int, default=200, help='Length of the synthetic patch history')
+    parser.add_argument('--patches', type=int, default=20, help='Patches applied per apply_patch run')
+    parser.add_argument('--mark-ratio', type=float, default=0.2, help='Fraction of files marked')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark')
+    parser.add_argument('--height', type=int, default=50, help='Fake screen height')
+    parser.add_argument('--width', type=int, default=160, help='Fake screen width')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--repo', metavar='DIR', help='Generate the project here and keep it')
+    parser.add_argument('--stress', type=int, metavar='WORKERS',
+                        help='Instead of timing, apply --patches patches from WORKERS processes at once and verify none are lost')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write JSON results to FILE (default: stdout)')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against an earlier JSON result')
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='Median ratio above which a benchmark counts as a regression')
+    args = parser.parse_args()
+
+    cwd = Path.cwd()
+    tmp = None
+    if args.repo:
+        repo = Path(args.repo).resolve()
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix='promptpack-bench-')
+        repo = Path(tmp.name)
+
+    if args.stress:
+        try:
+            start = time.perf_counter()
+            problems = stress_patches(repo, args.stress, args.patches)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+            if tmp:
+                tmp.cleanup()
+        for problem in problems:
+            print(f"🔴 {problem}")
+        if not problems:
+            print(f"✅ {args.stress * args.patches} patches from {args.stress} processes in {elapsed:.2f}s, nothing lost")
+        sys.exit(1 if problems else 0)
+
+    try:
+        results, counts = run_benchmarks(args, repo)
+    finally:
+        os.chdir(cwd)
+        if tmp:
+            tmp.cleanup()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'repo')},
+            'counts': counts,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+    elif not args.compare:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        regressions = compare(base, report, args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -26,11 +26,145 @@ import subprocess
 import shutil
 import re
 import re
+import time
+import atexit
+import cProfile
+import functools
+import pstats
+import hashlib
+import mmap
+import struct
+import bisect
+import heapq
+import base64
+import zlib
+import shlex
+import io
+import ast
+import tokenize
+import collections
+import fnmatch
+import queue
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import gzip
+import bz2
+import lzma
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+from array import array
 
 PROMPTPACK_FILE = Path.home() / '.promptpack'
 PATCH_HISTORY_FILE = Path('patch.json')
+OBJECT_STORE_DIR = Path('.promptpack_objects')
 CLIPBOARD_TMP_FILE = Path('clipboard.tmp')
+SINK_ENV = 'PROMPTPACK_SINK'
+# Komprimering för --output: namn -> (filändelse, öppna som skrivbar binär ström ovanpå en annan)
+OUTPUT_COMPRESSION = {
+    'gzip': ('.gz', lambda raw: gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)),
+    'bz2': ('.bz2', lambda raw: bz2.BZ2File(raw, 'wb')),
+    'xz': ('.xz', lambda raw: lzma.LZMAFile(raw, 'wb')),
+    'zstd': ('.zst', lambda raw: zstd.ZstdFile(raw, 'wb')),
+}
+CLIPBOARD_BACKENDS = [
+    ('wl-copy', ['wl-copy']),
+    ('xclip', ['xclip', '-selection', 'clipboard']),
+    ('xsel', ['xsel', '--clipboard', '--input']),
+    ('pbcopy', ['pbcopy'])
+]
 TEXT_CHECK_BYTES = 8192
+TEXT_EXTENSIONS = {
+    '.py', '.pyi', '.pyw', '.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx', '.mts', '.cts', '.json', '.md', '.txt',
+    '.rst', '.html', '.htm', '.css', '.scss', '.sass', '.less', '.xml', '.svg', '.yml', '.yaml', '.toml', '.ini',
+    '.cfg', '.conf', '.sh', '.bash', '.zsh', '.fish', '.c', '.h', '.cc', '.cpp', '.cxx', '.hh', '.hpp', '.hxx',
+    '.java', '.cs', '.go', '.rs', '.swift', '.kt', '.kts', '.scala', '.m', '.mm', '.rb', '.php', '.pl', '.pm',
+    '.lua', '.r', '.sql', '.vue', '.svelte', '.dart', '.ex', '.exs', '.erl', '.hs', '.ml', '.clj', '.csv',
+    '.tsv', '.gradle', '.properties', '.tex', '.proto', '.graphql'
+}
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.tif', '.tiff', '.psd', '.pdf', '.zip', '.gz',
+    '.tgz', '.bz2', '.xz', '.7z', '.rar', '.tar', '.zst', '.jar', '.war', '.class', '.so', '.dll', '.dylib',
+    '.exe', '.o', '.a', '.obj', '.lib', '.pyc', '.pyo', '.whl', '.egg', '.bin', '.woff', '.woff2', '.ttf',
+    '.otf', '.eot', '.mp3', '.mp4', '.wav', '.ogg', '.flac', '.avi', '.mov', '.mkv', '.webm', '.sqlite', '.db',
+    '.npy', '.npz', '.pkl', '.pickle', '.h5', '.parquet', '.onnx', '.pt', '.pth', '.ckpt', '.iso', '.dmg',
+    '.deb', '.rpm', '.wasm'
+}
+BINARY_MAGIC = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'%PDF-', b'PK\x03\x04', b'\x1f\x8b', b'\x7fELF', b'\xca\xfe\xba\xbe',
+    b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe', b'\xfd7zXZ', b'7z\xbc\xaf', b'Rar!', b'\x28\xb5\x2f\xfd',
+    b'SQLite format 3', b'\x00asm', b'OggS', b'RIFF', b'ID3', b'fLaC'
+)
+PATCH_INDEX_MAGIC = 'PPIDX1'
+PATCH_INDEX_HEADER = 64
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'promptpack'
+LINE_INDEX_BLOCK = 65536
+CAP_UNITS = {'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2}
+CAP_PATTERN = re.compile(r'^(\d+)\s*([KM]?B?)$', re.IGNORECASE)
+# Övre gräns för byte per token: en rad som är längre än så mot resterande budget tokeniseras inte ens
+CAP_TOKEN_BYTES = 16
+FINDER_LIMIT = 500
+POLL_MS = 100
+SCAN_GRACE = 0.2
+CODE_PART_PATTERN = 'code.part{}.txt'
+MANIFEST_PATTERN = '{}.manifest.json'
+SYMBOL_SEPARATOR = '::'
+SYMBOL_SKIP_KINDS = {'variable', 'local', 'parameter', 'unknown', 'import', 'package', 'namespace', 'module',
+                     'field', 'enumerator', 'label', 'alias', 'externvar', 'prototype'}
+DEFAULT_ENCODING = 'cl100k_base'
+ESTIMATE_ENCODING = 'estimate'
+# (name, context limit, tiktoken encoding or ESTIMATE_ENCODING for chars/4)
+MODELS = [
+    ('DeepSeek', 128000, 'cl100k_base'),
+    ('Grok', 128000, 'cl100k_base'),
+    ('GPT-4', 32768, 'cl100k_base'),
+    ('GPT-5', 128000, 'o200k_base'),
+    ('Claude', 200000, 'cl100k_base'),
+    ('Qwen', 128000, 'cl100k_base')
+]
+IMPORT_CACHE_FILE = CACHE_DIR / 'imports.json'
+FILETYPE_CACHE_FILE = CACHE_DIR / 'filetypes.json'
+SYMBOL_CACHE_FILE = CACHE_DIR / 'symbols.json'
+GIT_ENV = 'PROMPTPACK_GIT'
+JS_EXTENSIONS = ['.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs', '.mts', '.cts']
+JS_IMPORT_PATTERN = re.compile(
+    r'''(?:\bfrom\s*|\bimport\s*\(?\s*|\brequire\s*\(\s*)(['"])(\.{1,2}/[^'"\n]*|\.{1,2})\1''')
+LINE_INDEX_MAGIC = b'PPLI1'
+LINE_PATTERN = re.compile(r'[^\n]*\n|[^\n]+')
+PROFILE_ENV = 'PROMPTPACK_PROFILE'
+CPROFILE_ENV = 'PROMPTPACK_CPROFILE'
+
+# Projektrot per tråd, så biblioteks-API:t kan arbeta i flera projekt samtidigt utan chdir
+_PROJECT = threading.local()
+
+def project_root():
+    """Projektroten för den här tråden: satt av project(), annars arbetskatalogen"""
+    return getattr(_PROJECT, 'root', None) or Path.cwd()
+
+def project_path(path):
+    """En projektrelativ sökväg (patch.json, code.txt, ...) i den aktuella projektroten"""
+    return project_root() / path
+
+@contextlib.contextmanager
+def project(root):
+    """Kör ett block med root som projektrot i den här tråden"""
+    previous = getattr(_PROJECT, 'root', None)
+    _PROJECT.root = Path(root).resolve()
+    try:
+        yield _PROJECT.root
+    finally:
+        _PROJECT.root = previous
+
+def tmp_name(path):
+    """Temporärfil bredvid path, unik per process och tråd"""
+    path = Path(path)
+    return path.with_name(f"{path.name}.tmp{os.getpid()}.{threading.get_ident()}")
 
 def check_ctags():
     if not shutil.which('ctags'):
@@ -39,6 +173,174 @@ def check_ctags():
         print("  sudo apt install universal-ctags")
         sys.exit(1)
 
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    def __init__(self, profiler, name, trace):
+        self.profiler = profiler
+        self.name = name
+        self.trace = trace
+        self.counters = {}
+        self.cprof = None
+
+    def __enter__(self):
+        p = self.profiler
+        stack = p.stack
+        # cProfile bara på huvudtråden: profileraren är per tråd och yttersta fasen äger den
+        if p.cprofile_path and not stack and threading.current_thread() is threading.main_thread():
+            self.cprof = cProfile.Profile()
+            self.cprof.enable()
+        with p.lock:
+            if self.name not in p.phases:
+                p.phases[self.name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'depth': len(stack)}
+        stack.append(self)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        p = self.profiler
+        p.stack.pop()
+        if self.cprof:
+            self.cprof.disable()
+        
+        with p.lock:
+            if self.cprof:
+                p.profiles.setdefault(self.name, []).append(self.cprof)
+            stats = p.phases[self.name]
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            for key, value in self.counters.items():
+                stats[key] = stats.get(key, 0) + value
+            
+            if self.trace:
+                p.events.append({
+                    'name': self.name,
+                    'ph': 'X',
+                    'ts': (self.start_wall - p.origin) * 1e6,
+                    'dur': wall * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': dict(self.counters, cpu_ms=round(cpu * 1000, 3))
+                })
+        return False
+
+class Profiler:
+    """
+    Opt-in mätning av vägg-/CPU-tid och I/O per fas
+    Aktiveras med --profile eller PROMPTPACK_PROFILE (summary, fil.json eller fil.trace.json)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.target = None
+        self.cprofile_path = None
+        self.phases = {}
+        self.events = []
+        self.profiles = {}
+        # Fasstacken är per tråd (build_trees, BackgroundWork, grep och check kör faser på arbetartrådar);
+        # summeringarna delas och slås ihop under låset
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self._registered = False
+    
+    def configure(self, target=None, cprofile_path=None):
+        if not target and not cprofile_path:
+            return
+        self.enabled = True
+        self.target = target if target not in (None, '', '1') else 'summary'
+        self.cprofile_path = cprofile_path or None
+        if not self._registered:
+            atexit.register(self.report)
+            self._registered = True
+    
+    @property
+    def stack(self):
+        """Den aktuella trådens öppna faser, yttersta först"""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+    
+    def phase(self, name, trace=True):
+        """trace=False för högfrekventa faser som bara ska summeras"""
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name, trace)
+    
+    def count(self, **counters):
+        if not self.enabled:
+            return
+        for phase in self.stack:
+            for key, value in counters.items():
+                phase.counters[key] = phase.counters.get(key, 0) + value
+    
+    def as_dict(self):
+        return {
+            'phases': {name: dict(stats) for name, stats in self.phases.items()},
+            'total_wall': time.perf_counter() - self.origin,
+            'total_cpu': time.process_time()
+        }
+    
+    def report(self):
+        if not self.enabled or not (self.phases or self.profiles):
+            return
+        try:
+            if self.target == 'summary':
+                self._print_summary()
+            elif self.target.endswith('.trace.json') or self.target.endswith('.trace'):
+                with open(self.target, 'w', encoding='utf-8') as f:
+                    json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+                print(f"⏱️  Chrome trace written to {self.target}", file=sys.stderr)
+            else:
+                with open(self.target, 'w', encoding='utf-8') as f:
+                    json.dump(self.as_dict(), f, indent=2)
+                print(f"⏱️  Profile written to {self.target}", file=sys.stderr)
+            
+            if self.cprofile_path and self.profiles:
+                hottest = max(self.profiles, key=lambda name: self.phases[name]['wall'])
+                stats = pstats.Stats(*self.profiles[hottest], stream=sys.stderr)
+                stats.dump_stats(self.cprofile_path)
+                print(f"⏱️  cProfile of hottest phase '{hottest}' written to {self.cprofile_path}", file=sys.stderr)
+                stats.sort_stats('cumulative').print_stats(15)
+        except Exception as e:
+            print(f"Warning: Could not write profile: {e}", file=sys.stderr)
+    
+    def _print_summary(self):
+        out = sys.stderr
+        counter_keys = ['bytes_read', 'files', 'stat', 'listdir', 'subprocess']
+        out.write(f"\n{'Phase':<32} {'Calls':>7} {'Wall ms':>10} {'CPU ms':>10} {'Read':>10} {'Files':>7} {'Stats':>7} {'Dirs':>6} {'Procs':>6}\n")
+        for name, stats in self.phases.items():
+            label = ("  " * stats['depth'] + name)[:32]
+            cols = [f"{stats.get(k, 0):,}" for k in counter_keys]
+            out.write(
+                f"{label:<32} {stats['calls']:>7} {stats['wall'] * 1000:>10.1f} {stats['cpu'] * 1000:>10.1f} "
+                f"{cols[0]:>10} {cols[1]:>7} {cols[2]:>7} {cols[3]:>6} {cols[4]:>6}\n"
+            )
+
+PROFILER = Profiler()
+PROFILER.configure(os.environ.get(PROFILE_ENV), os.environ.get(CPROFILE_ENV))
+
+def profiled(name):
+    """Dekorator som mäter hela funktionen som en fas"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 class TreeNode:
     def __init__(self, path, is_dir=False, parent=None):
         self.path = Path(path)
@@ -49,15 +351,19 @@ class TreeNode:
         self.expanded = False
         self.marked = False
         self.size = 0
+        self.symbol_marks = set()
         
-    def calculate_size(self):
+    def calculate_size(self, stat=True):
         if not self.is_dir:
+            if not stat:
+                return self.size
+            PROFILER.count(stat=1)
             try:
                 self.size = self.path.stat().st_size
             except:
                 self.size = 0
         else:
-            self.size = sum(child.calculate_size() for child in self.children)
+            self.size = sum(child.calculate_size(stat) for child in self.children)
         return self.size
     
     def format_size(self):
@@ -70,23 +376,26 @@ class TreeNode:
     
     def has_partial_marks(self):
         if not self.is_dir:
-            return False
+            return bool(self.symbol_marks) and not self.marked
         
         marked_count = 0
         total_count = 0
+        symbols = False
         
         def count_marks(node):
-            nonlocal marked_count, total_count
+            nonlocal marked_count, total_count, symbols
             if not node.is_dir:
                 total_count += 1
                 if node.marked:
                     marked_count += 1
+                elif node.symbol_marks:
+                    symbols = True
             else:
                 for child in node.children:
                     count_marks(child)
         
         count_marks(self)
-        return 0 < marked_count < total_count
+        return 0 < marked_count < total_count or (symbols and marked_count < total_count)
         
     def toggle_expand(self):
         if self.is_dir:
@@ -94,6 +403,7 @@ class TreeNode:
             
     def toggle_mark(self):
         self.marked = not self.marked
+        self.symbol_marks = set()
         if self.is_dir and self.marked:
             self._mark_all_children(True)
         elif self.is_dir and not self.marked:
@@ -102,30 +412,211 @@ class TreeNode:
     def _mark_all_children(self, mark_state):
         for child in self.children:
             child.marked = mark_state
+            child.symbol_marks = set()
             if child.is_dir:
                 child._mark_all_children(mark_state)
 
-def calculate_tokens(text):
+class SymbolNode(TreeNode):
+    """En funktion/klass under en fil i trädvyn; markeringen lagras i filens symbol_marks"""
+    def __init__(self, file_node, symbol, kind, start, end):
+        super().__init__(file_node.path, parent=file_node)
+        self.symbol = symbol
+        self.name = f"{symbol} ({kind} {start}-{end})"
+        self.size = end - start + 1
+    
+    @property
+    def marked(self):
+        return self.parent.marked or self.symbol in self.parent.symbol_marks
+    
+    @marked.setter
+    def marked(self, value):
+        pass
+    
+    def format_size(self):
+        return f"{self.size:4d}L"
+    
+    def toggle_mark(self):
+        if self.parent.marked:
+            return
+        self.parent.symbol_marks ^= {self.symbol}
+    
+    def calculate_size(self, stat=True):
+        return 0
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(name):
+    """tiktoken-kodningen laddas en gång per process; None (även vid fel) betyder uppskattning"""
+    if name == ESTIMATE_ENCODING:
+        return None
     try:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
+        return tiktoken.get_encoding(name)
     except:
-        return len(text) // 4
+        return None
+
+def calculate_tokens(text, encoding_name=DEFAULT_ENCODING):
+    with PROFILER.phase('tokenize', trace=False):
+        encoding = get_encoding(encoding_name)
+        if encoding is None:
+            return len(text) // 4
+        try:
+            return len(encoding.encode(text, disallowed_special=()))
+        except:
+            return len(text) // 4
+
+def count_tokens_multi(text):
+    """Räkna text en gång per distinkt kodning i MODELS; Returns: dict kodning -> tokens"""
+    encodings = dict.fromkeys([DEFAULT_ENCODING] + [encoding for _, _, encoding in MODELS])
+    return {encoding: calculate_tokens(text, encoding) for encoding in encodings}
+
+# content hash -> token count, and path -> (mtime_ns, size, content hash)
+_TOKEN_CACHE = {}
+_FILE_DIGESTS = {}
+
+def content_hash(content):
+    return hashlib.blake2b(content.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+
+def read_text_hashed(file_path):
+    """Läs en textfil och hasha innehållet i samma svep"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        st = os.fstat(f.fileno())
+        content = f.read()
+    PROFILER.count(files=1, bytes_read=len(content))
+    digest = content_hash(content)
+    _FILE_DIGESTS[str(file_path)] = (st.st_mtime_ns, st.st_size, digest)
+    return content, digest
+
+def count_tokens_cached(content, digest=None, encoding=DEFAULT_ENCODING):
+    """Tokenisera varje unikt innehåll bara en gång per kodning"""
+    if digest is None:
+        digest = content_hash(content)
+    key = digest if encoding == DEFAULT_ENCODING else f"{encoding}:{digest}"
+    tokens = _TOKEN_CACHE.get(key)
+    if tokens is None:
+        tokens = calculate_tokens(content, encoding)
+        _TOKEN_CACHE[key] = tokens
+    return tokens
+
+def file_tokens(file_path):
+    """Tokens för en fil; oförändrade filer (mtime/storlek) läses inte om"""
+    known = _FILE_DIGESTS.get(str(file_path))
+    if known and known[2] in _TOKEN_CACHE:
+        st = os.stat(file_path)
+        PROFILER.count(stat=1)
+        if (st.st_mtime_ns, st.st_size) == known[:2]:
+            return _TOKEN_CACHE[known[2]]
+    content, digest = read_text_hashed(file_path)
+    return count_tokens_cached(content, digest)
+
+class StatCache:
+    """
+    Persistent cache i cachekatalogen: nyckel -> [mtime_ns, size, värde]
+    Laddas vid första användning och skrivs atomiskt (vid save() och vid exit) bara om något ändrats
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._lock = threading.Lock()
+        self.dirty = False
+    
+    @property
+    def data(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    try:
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            data = json.load(f)
+                    except (OSError, ValueError):
+                        data = {}
+                    atexit.register(self.save)
+                    self._data = data
+        return self._data
+    
+    def get(self, key, st):
+        known = self.data.get(key)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        return None
+    
+    def put(self, key, st, value):
+        self.data[key] = [st.st_mtime_ns, st.st_size, value]
+        self.dirty = True
+    
+    def save(self):
+        if not self.dirty:
+            return
+        with self._lock:
+            self._save_locked()
+    
+    def _save_locked(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = tmp_name(self.path)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                # Kopian tas i ett svep, så en bakgrundstråd som lägger till poster stör inte
+                json.dump(dict(self._data), f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+# "dev:inode" -> is_text, path -> imports, path -> symbols
+FILETYPE_CACHE = StatCache(FILETYPE_CACHE_FILE)
+IMPORT_CACHE = StatCache(IMPORT_CACHE_FILE)
+SYMBOL_CACHE = StatCache(SYMBOL_CACHE_FILE)
 
-def is_text_file(file_path):
+def _sniff_text(file_path):
+    """Läs början av filen: känt binärhuvud eller NUL-byte betyder binär"""
     try:
         with open(file_path, 'rb') as f:
             chunk = f.read(TEXT_CHECK_BYTES)
-            return b'\x00' not in chunk
+            PROFILER.count(files=1, bytes_read=len(chunk))
+            return b'\x00' not in chunk and not chunk.startswith(BINARY_MAGIC)
     except:
         return False
 
+def is_text_file(file_path, st=None):
+    """
+    Kända filändelser avgörs utan att öppna filen; övriga läses en gång och
+    resultatet sparas på inode/storlek/mtime så bara nya eller ändrade filer läses igen
+    st kan ges (t.ex. från git-indexet) för att slippa stat
+    """
+    with PROFILER.phase('classify', trace=False):
+        if st is None and not isinstance(file_path, os.DirEntry):
+            # En känd filändelse räcker inte för en sökväg som inte finns (DirEntry från trädet finns alltid)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return False
+            PROFILER.count(stat=1)
+        
+        suffix = os.path.splitext(os.fspath(file_path))[1].lower()
+        if suffix in TEXT_EXTENSIONS:
+            return True
+        if suffix in BINARY_EXTENSIONS:
+            return False
+        
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return False
+            PROFILER.count(stat=1)
+        key = f"{st.st_dev}:{st.st_ino}"
+        known = FILETYPE_CACHE.get(key, st)
+        if known is not None:
+            return bool(known)
+        
+        result = _sniff_text(file_path)
+        FILETYPE_CACHE.put(key, st, int(result))
+        return result
+
 def load_promptpack():
     if not PROMPTPACK_FILE.exists():
         return set()
     
     try:
-        cwd = Path.cwd().resolve()
+        cwd = project_root().resolve()
         paths = set()
         
         with open(PROMPTPACK_FILE, 'r', encoding='utf-8') as f:
@@ -152,9 +643,32 @@ def load_promptpack():
     except:
         return set()
 
-def save_promptpack(marked_files):
+def load_promptpack_symbols():
+    """Symbolrader (/abs/path::Name) i .promptpack för projektet; Returns: dict Path -> set of names"""
+    symbols = {}
+    if not PROMPTPACK_FILE.exists():
+        return symbols
     try:
-        cwd = Path.cwd().resolve()
+        cwd = project_root().resolve()
+        with open(PROMPTPACK_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                path, sep, name = line.strip().partition(SYMBOL_SEPARATOR)
+                if not sep or not Path(path).is_absolute():
+                    continue
+                abs_path = Path(path).resolve()
+                try:
+                    abs_path.relative_to(cwd)
+                except ValueError:
+                    continue
+                if abs_path.exists():
+                    symbols.setdefault(abs_path, set()).add(name)
+    except:
+        pass
+    return symbols
+
+def save_promptpack(marked_files, symbol_marks=None):
+    try:
+        cwd = project_root().resolve()
         
         existing_other_projects = set()
         if PROMPTPACK_FILE.exists():
@@ -164,7 +678,8 @@ def save_promptpack(marked_files):
                     if not line:
                         continue
                     
-                    path = Path(line)
+                    path_part, sep, name = line.partition(SYMBOL_SEPARATOR)
+                    path = Path(path_part)
                     if not path.is_absolute():
                         continue
                     
@@ -172,11 +687,16 @@ def save_promptpack(marked_files):
                     
                     try:
                         abs_path.relative_to(cwd)
+                        # symbol_marks=None keeps this project's symbol lines as they are
+                        if sep and symbol_marks is None and abs_path.exists():
+                            existing_other_projects.add(f"{abs_path}{SYMBOL_SEPARATOR}{name}")
                     except ValueError:
                         if abs_path.exists():
-                            existing_other_projects.add(str(abs_path))
+                            existing_other_projects.add(f"{abs_path}{sep}{name}")
         
         all_paths = existing_other_projects | {str(f.resolve()) for f in marked_files}
+        for path, names in (symbol_marks or {}).items():
+            all_paths |= {f"{Path(path).resolve()}{SYMBOL_SEPARATOR}{name}" for name in names}
         
         with open(PROMPTPACK_FILE, 'w', encoding='utf-8') as f:
             for path in sorted(all_paths):
@@ -185,6 +705,205 @@ def save_promptpack(marked_files):
     except Exception as e:
         pass
 
+def _line_index_path(filepath):
+    key = hashlib.blake2b(str(filepath).encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    return CACHE_DIR / 'lines' / f"{key}.idx"
+
+def _build_line_index(mm, size):
+    """
+    Ett glest radindex: (radnummer, byteoffset) vid radstarter ungefär var LINE_INDEX_BLOCK:e byte
+    Returns: (total_lines, array of interleaved line/offset pairs)
+    """
+    entries = array('Q', [0, 0])
+    pos = 0
+    line = 0
+    while pos < size:
+        nl = mm.find(b'\n', min(pos + LINE_INDEX_BLOCK, size) - 1)
+        end = size if nl == -1 else nl + 1
+        line += mm[pos:end].count(b'\n')
+        pos = end
+        if pos < size:
+            entries.extend((line, pos))
+    if size and mm[size - 1:size] != b'\n':
+        line += 1
+    return line, entries
+
+def load_line_index(filepath, mm, st):
+    """Hämta radindex från cachen om mtime/storlek stämmer, annars bygg och spara det"""
+    index_path = _line_index_path(filepath)
+    header = struct.Struct('<5sqqq')
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        magic, mtime_ns, size, total = header.unpack_from(data)
+        if magic == LINE_INDEX_MAGIC and (mtime_ns, size) == (st.st_mtime_ns, st.st_size):
+            entries = array('Q')
+            entries.frombytes(data[header.size:])
+            return total, entries
+    except (OSError, struct.error, ValueError):
+        pass
+    
+    with PROFILER.phase('line_index.build', trace=False):
+        total, entries = _build_line_index(mm, st.st_size)
+    try:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = tmp_name(index_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(header.pack(LINE_INDEX_MAGIC, st.st_mtime_ns, st.st_size, total))
+            f.write(entries.tobytes())
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+    return total, entries
+
+def _line_offset(mm, entries, line):
+    """Byteoffset där 0-baserad rad line börjar"""
+    lines = entries[0::2]
+    idx = bisect.bisect_right(lines, line) - 1
+    current, pos = entries[2 * idx], entries[2 * idx + 1]
+    while current < line:
+        pos = mm.find(b'\n', pos) + 1
+        current += 1
+    return pos
+
+def read_line_range(filepath, start, end):
+    """
+    Läs raderna start..end (1-baserat) via mmap och radindex
+    Returns: (start, end, total_lines, text) med start/end justerade som -n förväntar sig
+    """
+    with open(filepath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return max(1, start - end), 0, 0, ''
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    with mm:
+        total, entries = load_line_index(Path(filepath).resolve(), mm, st)
+        
+        # Auto-adjust if end exceeds file length
+        if end > total:
+            overflow = end - total
+            start = max(1, start - overflow)
+            end = total
+        if start < 1 or start > end:
+            return start, end, total, None
+        
+        begin = _line_offset(mm, entries, start - 1)
+        stop = _line_offset(mm, entries, end) if end < total else st.st_size
+        PROFILER.count(files=1, bytes_read=stop - begin)
+        text = mm[begin:stop].decode('utf-8').replace('\r\n', '\n')
+    return start, end, total, text
+
+def parse_cap(spec):
+    """
+    'LIMIT' eller 'GLOB=LIMIT'; LIMIT är tokens (8000) eller byte med enhet (64KB, 2M, 500B)
+    Returns: (glob eller None, 'tokens'|'bytes', limit)
+    """
+    pattern, sep, limit = spec.rpartition('=')
+    match = CAP_PATTERN.match(limit.strip())
+    if not match or int(match.group(1)) <= 0 or (sep and not pattern):
+        raise argparse.ArgumentTypeError(f"invalid cap '{spec}' (use 8000, 64KB or 'glob=LIMIT')")
+    number, unit = int(match.group(1)), match.group(2).upper()
+    if unit:
+        return pattern or None, 'bytes', number * CAP_UNITS[unit]
+    return pattern or None, 'tokens', number
+
+def cap_for(rel_path, caps):
+    """Sista mönstret som matchar sökvägen (eller filnamnet) vinner, annars sista globala gränsen"""
+    if not caps:
+        return None
+    rel_path = Path(rel_path).as_posix()
+    for pattern, kind, limit in reversed(caps):
+        if pattern and (fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(rel_path.rsplit('/', 1)[-1], pattern)):
+            return kind, limit
+    for pattern, kind, limit in reversed(caps):
+        if pattern is None:
+            return kind, limit
+    return None
+
+def read_capped(filepath, cap, display_path=None):
+    """
+    Läs början och slutet av en fil som är större än cap utan att läsa in resten
+    Markörens kostnad dras av först; huvudet får två tredjedelar av resten och svansen resten av det
+    Returns: (text, line_map, total_lines, (first_omitted, last_omitted)) eller None om filen ryms
+    """
+    kind, limit = cap
+    with open(filepath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        # En token täcker minst en byte, så en fil inom gränsen i byte ryms alltid
+        if st.st_size <= limit:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def cost(data, room=None):
+        """Kostnad för data, eller None när den säkert inte ryms i room (utan att tokenisera)"""
+        if kind == 'bytes':
+            return len(data)
+        if room is not None and len(data) > max(room, 0) * CAP_TOKEN_BYTES:
+            return None
+        return max(1, calculate_tokens(data.decode('utf-8', 'replace'))) if data else 0
+    
+    def marker(first, last):
+        return f"… lines {first:,}–{last:,} omitted, use promptpack -n {first},{last} {display_path or filepath}\n"
+    
+    with mm:
+        size = st.st_size
+        # Markören räknas av från gränsen först; radnummer har aldrig fler siffror än filen har byte
+        budget = max(0, limit - cost(marker(size, size).encode('utf-8')))
+        head_budget = budget - budget // 3
+        heads = [0]
+        used = 0
+        while heads[-1] < size:
+            pos = heads[-1]
+            nl = mm.find(b'\n', pos)
+            end = size if nl == -1 else nl + 1
+            line_cost = cost(mm[pos:end], head_budget - used)
+            if line_cost is None or used + line_cost > head_budget:
+                break
+            used += line_cost
+            heads.append(end)
+        
+        tail_budget = budget - used
+        tails = [size]
+        used = 0
+        while tails[-1] > heads[-1]:
+            tail = tails[-1]
+            start = max(heads[-1], mm.rfind(b'\n', heads[-1], tail - 1) + 1)
+            line_cost = cost(mm[start:tail], tail_budget - used)
+            if line_cost is None or used + line_cost > tail_budget:
+                break
+            used += line_cost
+            tails.append(start)
+        
+        if tails[-1] <= heads[-1]:
+            return None
+        total, _ = load_line_index(Path(filepath).resolve(), mm, st)
+        while True:
+            pos, tail = heads[-1], tails[-1]
+            first, last = len(heads), total - len(tails) + 1
+            note = marker(first, last)
+            head = mm[:pos].decode('utf-8').replace('\r\n', '\n')
+            rest = mm[tail:].decode('utf-8').replace('\r\n', '\n')
+            if rest and not rest.endswith('\n'):
+                rest += '\n'
+            # Radvisa kostnader summerar inte exakt till helheten; släpp rader (svansen först) tills den ryms
+            excess = cost((head + note + rest).encode('utf-8')) - limit if kind == 'tokens' else 0
+            if excess <= 0 or len(heads) + len(tails) == 2:
+                break
+            while excess > 0 and len(heads) + len(tails) > 2:
+                lines = tails if len(tails) > 1 else heads
+                dropped = lines.pop()
+                excess -= cost(mm[min(dropped, lines[-1]):max(dropped, lines[-1])])
+        
+        # Kostar det utelämnade mindre än markören blir det mindre att ta med hela filen
+        note_cost = cost(note.encode('utf-8'))
+        if tail - pos <= note_cost * CAP_TOKEN_BYTES and cost(mm[pos:tail]) <= note_cost:
+            return None
+        PROFILER.count(files=1, bytes_read=pos + size - tail)
+    
+    line_map = list(range(1, first + 1)) + list(range(last + 1, total + 1))
+    return head + note + rest, line_map, total, (first, last)
+
 def read_lines_to_clipboard(line_range, filepath):
     """Läs specifika rader och kopiera till clipboard"""
     filepath = Path(filepath)
@@ -195,35 +914,24 @@ def read_lines_to_clipboard(line_range, filepath):
     
     try:
         start, end = map(int, line_range.split(','))
-        
-
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # Auto-adjust if end exceeds file length
-        if end > len(lines):
-            overflow = end - len(lines)
-            start = max(1, start - overflow)
-            end = len(lines)
-        
-        if start < 1 or start > end:
-            error_msg = f"Invalid range {start},{end} (file has {len(lines)} lines)"
+    except ValueError:
+        error_msg = f"Invalid range format: {line_range} (use: start,end)"
+        return False, error_msg
+    
+    try:
+        start, end, total, text = read_line_range(filepath, start, end)
+        if text is None or start > end:
+            error_msg = f"Invalid range {start},{end} (file has {total} lines)"
             return False, error_msg
         
-
-        rel_path = filepath.relative_to(Path.cwd()) if filepath.is_absolute() else filepath
-        header = f"\n------ {rel_path} ------\n\n"
-        selected_with_numbers = header
-        for i, line in enumerate(lines[start-1:end], start=start):
-            selected_with_numbers += f"{i}: {line}"
+        rel_path = filepath.relative_to(project_root()) if filepath.is_absolute() else filepath
+        parts = [f"\n------ {rel_path} ------\n\n"]
+        parts.extend(f"{i}: {line}" for i, line in enumerate(LINE_PATTERN.findall(text), start=start))
         
         success_msg = f"✅ Read lines {start}-{end} from {rel_path}"
-        append_to_clipboard_tmp(selected_with_numbers)
+        append_to_clipboard_tmp(''.join(parts))
         return True, success_msg
             
-    except ValueError:
-        error_msg = f"Invalid range format: {line_range} (use: start,end)"
-        return False, error_msg
     except Exception as e:
         error_msg = f"Error reading file: {e}"
         return False, error_msg
@@ -241,7 +949,7 @@ def read_file_to_clipboard(filepath):
         with open(filepath, 'r', encoding='utf-8') as f:
             content = f.read()
         
-        rel_path = filepath.relative_to(Path.cwd()) if filepath.is_absolute() else filepath
+        rel_path = filepath.relative_to(project_root()) if filepath.is_absolute() else filepath
         success_msg = f"✅ Read {len(content)} bytes from {rel_path}"
         append_to_clipboard_tmp(content)
         return True, success_msg
@@ -253,15 +961,137 @@ def read_file_to_clipboard(filepath):
 def append_to_clipboard_tmp(message):
     """Lägg till meddelande till clipboard.tmp"""
     try:
-        with open(CLIPBOARD_TMP_FILE, 'a', encoding='utf-8') as f:
-            f.write(message + '\n')
+        with file_lock(CLIPBOARD_TMP_FILE):
+            with open(CLIPBOARD_TMP_FILE, 'a', encoding='utf-8') as f:
+                f.write(message + '\n')
         return True
     except Exception as e:
         print(f"Warning: Could not write to clipboard.tmp: {e}")
         return False
 
-def copy_clipboard_tmp_to_clipboard():
-    """Kopiera innehållet av clipboard.tmp till clipboard"""
+@functools.lru_cache(maxsize=None)
+def clipboard_backend():
+    """Leta upp clipboard-verktyget en gång per process"""
+    for name, command in CLIPBOARD_BACKENDS:
+        if name == 'wl-copy' and not os.environ.get('WAYLAND_DISPLAY'):
+            continue
+        if shutil.which(command[0]):
+            return command
+    return None
+
+class ClipboardSink:
+    name = 'clipboard'
+    error = "Could not copy to clipboard (install xclip, xsel, or pbcopy)"
+    
+    def write(self, text):
+        command = clipboard_backend()
+        if not command:
+            return False
+        try:
+            PROFILER.count(subprocess=1)
+            subprocess.run(command, input=text.encode(), check=True)
+            return True
+        except:
+            return False
+
+class StdoutSink:
+    name = 'stdout'
+    error = "Could not write to stdout"
+    
+    def write(self, text):
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return True
+        except OSError:
+            return False
+
+class FileSink:
+    name = 'file'
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.error = f"Could not write to {self.path}"
+    
+    def write(self, text):
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            return True
+        except OSError:
+            return False
+
+class Osc52Sink:
+    """Kopiera via terminalens OSC 52-sekvens, fungerar även över ssh"""
+    name = 'osc52'
+    error = "Could not write OSC 52 sequence to the terminal"
+    
+    def write(self, text):
+        payload = base64.b64encode(text.encode('utf-8')).decode('ascii')
+        sequence = f"\033]52;c;{payload}\a"
+        if os.environ.get('TMUX'):
+            sequence = "\033Ptmux;" + sequence.replace("\033", "\033\033") + "\033\\"
+        try:
+            with open('/dev/tty', 'w') as tty:
+                tty.write(sequence)
+            return True
+        except OSError:
+            try:
+                sys.stdout.write(sequence)
+                sys.stdout.flush()
+                return True
+            except OSError:
+                return False
+
+def get_sink(spec=None):
+    """
+    Välj utdata för -c: clipboard (standard), stdout, osc52 eller file:PATH
+    Returns: sink eller None om spec är okänd
+    """
+    spec = spec or os.environ.get(SINK_ENV) or 'clipboard'
+    if spec == 'clipboard':
+        return ClipboardSink()
+    if spec in ('stdout', '-'):
+        return StdoutSink()
+    if spec == 'osc52':
+        return Osc52Sink()
+    if spec.startswith('file:'):
+        return FileSink(spec[5:])
+    return None
+
+def output_compression(target, compression=None):
+    """Komprimeringen för target: angiven, annars efter filändelsen (.gz, .bz2, .xz, .zst); None = okomprimerat"""
+    if compression:
+        return compression
+    for name, (suffix, _) in OUTPUT_COMPRESSION.items():
+        if target != '-' and str(target).endswith(suffix):
+            return name
+    return None
+
+@contextlib.contextmanager
+def open_output(target, compression=None):
+    """
+    Textström för paketet: '-' är stdout, annars en fil eller namngiven pipe, valfritt komprimerad
+    Skrivs i block medan paketet byggs, så mottagaren kan börja läsa direkt
+    """
+    compression = output_compression(target, compression)
+    if compression == 'zstd' and zstd is None:
+        raise ValueError("zstd needs Python 3.14 (compression.zstd); use gzip, bz2 or xz")
+    if target == '-':
+        # En kopia av fd 1 (inte sys.stdout, som CLI:t pekar om till stderr) så stdout inte stängs efteråt
+        raw = os.fdopen(os.dup(1), 'wb')
+    else:
+        raw = open(target, 'wb')
+    try:
+        stream = OUTPUT_COMPRESSION[compression][1](raw) if compression else raw
+        with io.TextIOWrapper(stream, encoding='utf-8') as out:
+            yield out
+    finally:
+        raw.close()
+
+@profiled('clipboard')
+def flush_clipboard_tmp(sink):
+    """Skicka hela clipboard.tmp till sink i ett svep"""
     try:
         if not CLIPBOARD_TMP_FILE.exists():
             return False
@@ -269,193 +1099,476 @@ def copy_clipboard_tmp_to_clipboard():
         with open(CLIPBOARD_TMP_FILE, 'r', encoding='utf-8') as f:
             content = f.read()
         
-        return copy_to_clipboard(content)
+        return sink.write(content)
     except Exception as e:
         print(f"Warning: Could not read clipboard.tmp: {e}")
         return False
 
 def copy_to_clipboard(text):
     """Kopiera text till clipboard"""
-    try:
-        if shutil.which('xclip'):
-            subprocess.run(['xclip', '-selection', 'clipboard'], 
-                         input=text.encode(), check=True)
-            return True
-        elif shutil.which('xsel'):
-            subprocess.run(['xsel', '--clipboard', '--input'], 
-                         input=text.encode(), check=True)
-            return True
-        elif shutil.which('pbcopy'):
-            subprocess.run(['pbcopy'], input=text.encode(), check=True)
-            return True
-    except:
-        pass
-    return False
+    return ClipboardSink().write(text)
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exklusivt fcntl-lås för path, delat mellan processer och trådar
+    Låsfilen ligger i cachekatalogen så projektet inte skräpas ner
+    """
+    if fcntl is None:
+        yield
+        return
+    key = hashlib.blake2b(str(Path(path).resolve()).encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    lock_path = CACHE_DIR / 'locks' / f"{key}.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, 'a') as lock:
+        with PROFILER.phase('lock_wait', trace=False):
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+def journal_lock():
+    """Lås för patch.json; tas alltid efter eventuella fillås för att undvika deadlock"""
+    return file_lock(project_path(PATCH_HISTORY_FILE))
 
 def load_patch_history():
     """Ladda patch historik från JSON"""
-    if not PATCH_HISTORY_FILE.exists():
+    history_file = project_path(PATCH_HISTORY_FILE)
+    if not history_file.exists():
         return []
     try:
-        with open(PATCH_HISTORY_FILE, 'r', encoding='utf-8') as f:
+        with open(history_file, 'r', encoding='utf-8') as f:
             return json.load(f)
     except Exception as e:
         print(f"Warning: Could not load patch history: {e}")
         return []
 
-def save_patch_history(history):
-    """Spara patch historik till JSON"""
+def save_patch_history(history, index=True):
+    """
+    Spara patch historik till JSON; ersätts atomiskt så olåsta läsare aldrig ser en halv fil
+    index=False låter anroparen uppdatera historikindexet själv (se update_patch_index_flag)
+    """
     try:
-        with open(PATCH_HISTORY_FILE, 'w', encoding='utf-8') as f:
+        history_file = project_path(PATCH_HISTORY_FILE)
+        tmp_path = tmp_name(history_file)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(history, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, history_file)
+        if index:
+            write_patch_index(history)
         return True
     except Exception as e:
         print(f"Error saving patch history: {e}")
         return False
 
-def get_next_patch_id():
-    """Få nästa lediga patch ID"""
+def _patch_index_path():
+    key = hashlib.blake2b(str(project_path(PATCH_HISTORY_FILE).resolve()).encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    return CACHE_DIR / 'history' / f"{key}.idx"
+
+def _index_header(st, count, width):
+    """Huvud med fast längd så stämpeln kan skrivas om på plats: magi, patch.json:s mtime/storlek, rader, radbredd"""
+    header = f"{PATCH_INDEX_MAGIC} {st.st_mtime_ns} {st.st_size} {count} {width}".encode('ascii')
+    return header.ljust(PATCH_INDEX_HEADER - 1) + b'\n'
+
+def _parse_index_header(data):
+    """Returns: (mtime_ns, size, count, width); ValueError om huvudet inte är ett historikindex"""
+    fields = data[:PATCH_INDEX_HEADER].split()
+    if len(fields) != 5 or fields[0] != PATCH_INDEX_MAGIC.encode('ascii'):
+        raise ValueError("not a patch index")
+    return tuple(int(field) for field in fields[1:])
+
+def _index_line(patch):
+    """Flagga först så en växling bara skriver en byte; blanksteg i fälten blir mellanslag"""
+    fields = [str(patch['id']), patch['timestamp'][:19].replace('T', ' '), patch['description'], patch['filepath']]
+    return '\t'.join(['1' if patch['applied'] else '0'] + [re.sub(r'\s', ' ', field) for field in fields]).encode('utf-8')
+
+def _index_bytes(history, st):
+    lines = [_index_line(p) for p in history]
+    width = max(map(len, lines), default=0) + 1
+    return b''.join([_index_header(st, len(lines), width)] + [line.ljust(width - 1) + b'\n' for line in lines])
+
+class PatchIndex:
+    """
+    Sammanfattningsrader (utan old/new text) för historikvyn, med fast radbredd:
+    rad i ligger på PATCH_INDEX_HEADER + i * width, så vyn läser bara de rader den visar eller filtrerar
+    """
+    def __init__(self, data):
+        self.data = data
+        self.mtime_ns, self.size, self.count, self.width = _parse_index_header(data)
+        if len(data) != PATCH_INDEX_HEADER + self.count * self.width:
+            raise ValueError("truncated patch index")
+    
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mm)
+        except ValueError:
+            mm.close()
+            raise
+    
+    def __len__(self):
+        return self.count
+    
+    def _raw(self, i):
+        start = PATCH_INDEX_HEADER + i * self.width
+        return self.data[start:start + self.width]
+    
+    def row(self, i):
+        """[id, applied, datum, beskrivning, filsökväg]"""
+        applied, patch_id, timestamp, description, filepath = self._raw(i).decode('utf-8').rstrip('\n ').split('\t')
+        return [int(patch_id), applied == '1', timestamp, description, filepath]
+    
+    def patch_id(self, i):
+        return int(self._raw(i).split(b'\t', 2)[1])
+    
+    def find(self, patch_id):
+        """Radnumret för ett patch-id (id:n växer i historiken), eller None"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.patch_id(mid) < patch_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.patch_id(lo) == patch_id else None
+    
+    def current(self):
+        """Stämmer indexet (läst på nytt, det kan ha uppdaterats på plats) med patch.json?"""
+        try:
+            st = project_path(PATCH_HISTORY_FILE).stat()
+            return _parse_index_header(self.data)[:2] == (st.st_mtime_ns, st.st_size)
+        except (OSError, ValueError):
+            return False
+    
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+def write_patch_index(history):
+    """Skriv historikindexet, nycklat på patch.json:s mtime/storlek"""
+    try:
+        st = project_path(PATCH_HISTORY_FILE).stat()
+        index_path = _patch_index_path()
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = tmp_name(index_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(_index_bytes(history, st))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+
+def update_patch_index_flag(position, patch, before):
+    """
+    Skriv bara flaggbyten för en växlad patch och förnya stämpeln, i stället för att skriva om indexet
+    before: patch.json:s stat före sparningen; indexet måste ha varit aktuellt då
+    Returns: True om indexet uppdaterades på plats
+    """
+    try:
+        st = project_path(PATCH_HISTORY_FILE).stat()
+        with open(_patch_index_path(), 'r+b') as f:
+            mtime_ns, size, count, width = _parse_index_header(f.read(PATCH_INDEX_HEADER))
+            if (mtime_ns, size) != (before.st_mtime_ns, before.st_size) or position >= count:
+                return False
+            f.seek(PATCH_INDEX_HEADER + position * width)
+            if f.read(width).split(b'\t', 2)[1] != str(patch['id']).encode('ascii'):
+                return False
+            f.seek(PATCH_INDEX_HEADER + position * width)
+            f.write(b'1' if patch['applied'] else b'0')
+            f.seek(0)
+            f.write(_index_header(st, count, width))
+        return True
+    except (OSError, ValueError, IndexError):
+        return False
+
+def load_patch_index():
+    """Historikindexet för vyn, eller None utan historik; hela patch.json läses bara om indexet är inaktuellt"""
+    history_file = project_path(PATCH_HISTORY_FILE)
+    if not history_file.exists():
+        return None
+    try:
+        index = PatchIndex.open(_patch_index_path())
+        if index.current():
+            return index
+        index.close()
+    except (OSError, ValueError):
+        pass
     history = load_patch_history()
-    if not history:
-        return 1
-    return max(p['id'] for p in history) + 1
+    write_patch_index(history)
+    try:
+        return PatchIndex.open(_patch_index_path())
+    except (OSError, ValueError):
+        # Cachekatalogen går inte att skriva: samma format, men i minnet
+        return PatchIndex(_index_bytes(history, history_file.stat()))
+
+def decode_source(data):
+    """Avkoda filinnehåll med samma radbrytningshantering som textläge"""
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+def find_patch_match(content, old_text):
+    """
+    Hitta old_text i content, först exakt och sedan med flexibla blanksteg
+    Returns: (start, end, flexible, count) där count är antalet träffar
+    """
+    # Try exact match first
+    if old_text in content:
+        start = content.index(old_text)
+        return start, start + len(old_text), False, content.count(old_text)
+    
+    # Try whitespace-agnostic matching
+    # Replace whitespace BEFORE escaping special chars
+    pattern = re.sub(r'\s+', '\x00WHITESPACE\x00', old_text)
+    pattern = re.escape(pattern)
+    pattern = pattern.replace('\x00WHITESPACE\x00', r'\s+')
+    matches = list(re.finditer(pattern, content))
+    if not matches:
+        return None, None, True, 0
+    return matches[0].start(), matches[0].end(), True, len(matches)
+
+def _apply_patch_locked(filepath, description, old_text, new_text):
+    """
+    Själva patchningen; anroparen håller fillåset och journalen låses bara för id och historikrad
+    Returns: (patch_id, used_flexible_whitespace, error_msg)
+    """
+    with open(filepath, 'rb') as f:
+        original_bytes = f.read()
+    PROFILER.count(files=1, bytes_read=len(original_bytes))
+    original_content = decode_source(original_bytes)
+    with PROFILER.phase('apply_patch.match'):
+        start, end, used_flexible_whitespace, count = find_patch_match(original_content, old_text)
+    
+    if count == 0:
+        rel_path = filepath.relative_to(project_root())
+        error_msg = f"[{rel_path}]\t\t'{description}': Old text not found in file (even with flexible whitespace)"
+        return None, False, error_msg
+    elif count > 1:
+        rel_path = filepath.relative_to(project_root())
+        error_msg = f"[{rel_path}]\t\t'{description}': Old text appears {count} times in file (must be unique)"
+        return None, False, error_msg
+    
+    # Use the actual text from file (with correct whitespace)
+    actual_old_text = original_content[start:end]
+    
+    new_content = original_content[:start] + new_text + original_content[start + len(actual_old_text):]
+    new_bytes = new_content.encode('utf-8')
+    
+    with PROFILER.phase('apply_patch.snapshot'):
+        pre_image = store_blob(original_bytes)
+        post_image = store_blob(new_bytes)
+    
+    with PROFILER.phase('apply_patch.write'):
+        with open(filepath, 'wb') as f:
+            f.write(new_bytes)
+    
+    patch_entry = {
+        'timestamp': datetime.now().isoformat(),
+        'filepath': str(filepath),
+        'description': description,
+        'old_text': old_text,
+        'new_text': new_text,
+        'applied': True,
+        'offset': len(original_content[:start].encode('utf-8')),
+        'pre_image': pre_image,
+        'post_image': post_image
+    }
+    if actual_old_text != old_text:
+        patch_entry['matched_text'] = actual_old_text
+    
+    with PROFILER.phase('apply_patch.history'):
+        with journal_lock():
+            history = load_patch_history()
+            patch_id = max((p['id'] for p in history), default=0) + 1
+            history.append(dict(patch_entry, id=patch_id))
+            save_patch_history(history)
+    return patch_id, used_flexible_whitespace, None
 
 def apply_patch(filepath, description, old_text, new_text):
     """
     Applicera en patch och spara i historiken
     Returns: (success: bool, message: str)
     """
+    success, message, _ = patch_file(filepath, description, old_text, new_text)
+    if success:
+        append_to_clipboard_tmp(message)
+    return success, message
 
-    filepath = Path(filepath).resolve()
+@profiled('apply_patch')
+def patch_file(filepath, description, old_text, new_text):
+    """
+    Som apply_patch men utan clipboard.tmp; filepath tolkas relativt projektroten
+    Returns: (success, message, patch_id)
+    """
+
+    filepath = project_path(filepath).resolve()
     
 
     if not filepath.exists():
-        rel_path = Path(filepath).relative_to(Path.cwd())
+        rel_path = Path(filepath).relative_to(project_root())
         error_msg = f"File not found: {rel_path}"
-        return False, error_msg
+        return False, error_msg, None
     
     words = description.split()
     if len(words) > 10:
-        rel_path = filepath.relative_to(Path.cwd())
+        rel_path = filepath.relative_to(project_root())
         error_msg = f"[{rel_path}]\t\t'Description too long ({len(words)} words, max 10)'"
-        return False, error_msg
+        return False, error_msg, None
     
     
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            original_content = f.read()
-        # Try exact match first
-        used_flexible_whitespace = False
-        if old_text in original_content:
-            count = original_content.count(old_text)
-            if count > 1:
-                rel_path = filepath.relative_to(Path.cwd())
-                error_msg = f"[{rel_path}]\t\t'{description}': Old text appears {count} times in file (must be unique)"
-                return False, error_msg
-            actual_old_text = old_text
-        else:
-            used_flexible_whitespace = True
-# Try whitespace-agnostic matching
-            # Replace whitespace BEFORE escaping special chars
-            pattern = re.sub(r'\s+', '\x00WHITESPACE\x00', old_text)
-            pattern = re.escape(pattern)
-            pattern = pattern.replace('\x00WHITESPACE\x00', r'\s+')
-            matches = list(re.finditer(pattern, original_content))
-            
-
-            if len(matches) == 0:
-                rel_path = filepath.relative_to(Path.cwd())
-                error_msg = f"[{rel_path}]\t\t'{description}': Old text not found in file (even with flexible whitespace)"
-                return False, error_msg
-            elif len(matches) > 1:
-                rel_path = filepath.relative_to(Path.cwd())
-                error_msg = f"[{rel_path}]\t\t'{description}': Old text appears {len(matches)} times in file (must be unique)"
-                return False, error_msg
-            
-            # Use the actual text from file (with correct whitespace)
-            actual_old_text = matches[0].group(0)
-        
-        new_content = original_content.replace(actual_old_text, new_text)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(new_content)
-        
-        history = load_patch_history()
-        patch_id = get_next_patch_id()
-        
-        patch_entry = {
-            'id': patch_id,
-            'timestamp': datetime.now().isoformat(),
-            'filepath': str(filepath),
-            'description': description,
-            'old_text': old_text,
-            'new_text': new_text,
-            'applied': True
-        }
+        with file_lock(filepath):
+            patch_id, used_flexible_whitespace, error_msg = _apply_patch_locked(filepath, description, old_text, new_text)
+        if error_msg:
+            return False, error_msg, None
         
-        history.append(patch_entry)
-        save_patch_history(history)
-        
-
-
-
-
-
-        rel_path = filepath.relative_to(Path.cwd())
+        rel_path = filepath.relative_to(project_root())
         flex_indicator = " (flexible whitespace)" if used_flexible_whitespace else ""
         success_msg = f"🧩 {rel_path}\t\t{description}: Applied successfully{flex_indicator}"
-        append_to_clipboard_tmp(success_msg)
-        return True, success_msg
+        return True, success_msg, patch_id
         
 
 
 
     except Exception as e:
-        rel_path = filepath.relative_to(Path.cwd())
+        rel_path = filepath.relative_to(project_root())
         error_msg = f"[{rel_path}]\t\t'{description}': Error: {e}"
-        return False, error_msg
+        return False, error_msg, None
 
-def unapply_patch(patch_id):
+def blob_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def _blob_path(digest):
+    return project_path(OBJECT_STORE_DIR) / digest[:2] / digest[2:]
+
+def store_blob(data):
+    """Spara innehåll i objektlagret (deduplicerat på hash) och returnera hashen"""
+    digest = blob_hash(data)
+    path = _blob_path(digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = tmp_name(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(tmp_path, path)
+    return digest
+
+def load_blob(digest):
+    with open(_blob_path(digest), 'rb') as f:
+        return zlib.decompress(f.read())
+
+def gc_object_store(history=None):
     """
-    Reversa en patch
-    Returns: (success: bool, message: str)
+    Ta bort objekt som ingen patch i historiken refererar till
+    Returns: (removed_count, freed_bytes)
     """
-    history = load_patch_history()
+    if history is None:
+        history = load_patch_history()
+    referenced = set()
+    for patch in history:
+        for key in ('pre_image', 'post_image'):
+            if patch.get(key):
+                referenced.add(patch[key])
     
-    patch = None
-    for p in history:
-        if p['id'] == patch_id:
-            patch = p
-            break
+    removed = 0
+    freed = 0
+    store = project_path(OBJECT_STORE_DIR)
+    if not store.exists():
+        return removed, freed
+    for bucket in store.iterdir():
+        if not bucket.is_dir():
+            continue
+        for obj in bucket.iterdir():
+            if bucket.name + obj.name not in referenced:
+                freed += obj.stat().st_size
+                obj.unlink()
+                removed += 1
+        try:
+            bucket.rmdir()
+        except OSError:
+            pass
+    return removed, freed
+
+def revert_patch_content(content, patch, undo):
+    """
+    Räkna ut filens bytes efter att patchen ångrats (undo=True) eller gjorts om
+    1. Filen är identisk med patchens efter-/förebild: återställ ögonblicksbilden
+    2. Texten ligger kvar på sparad byteoffset: skarva in på offseten
+    3. Offseten har glidit: skarva vid den enda förekomsten av texten
+    Returns: (new_content: bytes | None, offset, error)
+    """
+    old = patch.get('matched_text', patch['old_text']).encode('utf-8')
+    new = patch['new_text'].encode('utf-8')
+    current, target = (new, old) if undo else (old, new)
+    source_image, target_image = ('post_image', 'pre_image') if undo else ('pre_image', 'post_image')
     
-    if not patch:
-        return False, f"Patch #{patch_id} not found"
+    if patch.get(source_image) and patch.get(target_image) and blob_hash(content) == patch[source_image]:
+        try:
+            return load_blob(patch[target_image]), patch.get('offset'), None
+        except (OSError, zlib.error):
+            pass
     
+    offset = patch.get('offset')
+    if offset is None or content[offset:offset + len(current)] != current:
+        count = content.count(current)
+        if count == 0:
+            return None, None, "text not found in file"
+        if count > 1:
+            return None, None, f"text appears {count} times in file"
+        offset = content.index(current)
+    return content[:offset] + target + content[offset + len(current):], offset, None
 
-    if not patch['applied']:
-        return False, f"Patch #{patch_id} is already unapplied"
+def _patch_filepath(patch_id):
+    """Filen en patch gäller, via indexet (binärsökning) och annars patch.json"""
+    index = load_patch_index()
+    if index is not None:
+        try:
+            position = index.find(patch_id)
+            if position is not None:
+                return index.row(position)[4]
+        finally:
+            index.close()
+    return next((p['filepath'] for p in load_patch_history() if p['id'] == patch_id), None)
+
+def _toggle_patch(patch_id, undo):
+    filepath = _patch_filepath(patch_id)
+    if filepath is None:
+        return False, f"Patch #{patch_id} not found"
     
-    filepath = Path(patch['filepath'])
+    filepath = Path(filepath)
     if not filepath.exists():
-        rel_path = Path(patch['filepath']).relative_to(Path.cwd())
+        rel_path = filepath.relative_to(project_root())
         return False, f"File not found: {rel_path}"
     
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        if patch['new_text'] not in content:
-            return False, f"Cannot unpatch: new text not found in file"
-        
-        content = content.replace(patch['new_text'], patch['old_text'])
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        patch['applied'] = False
-        save_patch_history(history)
+        with file_lock(filepath), journal_lock():
+            # Read under the lock so a concurrent toggle or new patch is not lost
+            before = project_path(PATCH_HISTORY_FILE).stat()
+            history = load_patch_history()
+            position, patch = next(((i, p) for i, p in enumerate(history) if p['id'] == patch_id), (None, None))
+            if patch is None:
+                return False, f"Patch #{patch_id} not found"
+            if patch['applied'] != undo:
+                return False, f"Patch #{patch_id} is already {'unapplied' if undo else 'applied'}"
+            
+            with open(filepath, 'rb') as f:
+                content = f.read()
+            
+            new_content, offset, error = revert_patch_content(content, patch, undo)
+            if new_content is None:
+                return False, f"Cannot {'unpatch' if undo else 'reapply'}: {'new' if undo else 'old'} {error}"
+            
+            with open(filepath, 'wb') as f:
+                f.write(new_content)
+            
+            patch['applied'] = not undo
+            if offset is not None:
+                patch['offset'] = offset
+            # Only the toggled row's flag changes in the index
+            if save_patch_history(history, index=False) and not update_patch_index_flag(position, patch, before):
+                write_patch_index(history)
         
-        success_msg = f"Patch #{patch_id} unapplied successfully"
+        success_msg = f"Patch #{patch_id} {'unapplied' if undo else 'reapplied'} successfully"
         copy_to_clipboard(success_msg)
         return True, success_msg
         
@@ -464,54 +1577,255 @@ def unapply_patch(patch_id):
         copy_to_clipboard(error_msg)
         return False, error_msg
 
+def unapply_patch(patch_id):
+    """
+    Reversa en patch
+    Returns: (success: bool, message: str)
+    """
+    return _toggle_patch(patch_id, undo=True)
+
 def reapply_patch(patch_id):
     """
     Återapplicera en patch
     Returns: (success: bool, message: str)
     """
-    history = load_patch_history()
+    return _toggle_patch(patch_id, undo=False)
+
+PATCH_COMMAND_PATTERN = re.compile(r"""^\s*cat\s+<<-?\s*(['"]?)(\w+)\1\s*\|\s*promptpack\s+(?:-p|--patch)\s+(.*)$""")
+
+def split_patch_input(text):
+    """Dela stdin-formatet OLD_TEXT---SPLIT---NEW_TEXT; None om formatet är fel"""
+    parts = text.split('---SPLIT---')
+    if len(parts) != 2:
+        return None
+    return parts[0], parts[1]
+
+def parse_patch_stream(text):
+    """
+    Plocka ut alla promptpack -p heredocs ur ett bash-block
+    Returns: list of dicts med index, file, description, old_text, new_text (eller error)
+    """
+    patches = []
+    lines = text.split('\n')
+    i = 0
+    while i < len(lines):
+        match = PATCH_COMMAND_PATTERN.match(lines[i])
+        i += 1
+        if not match:
+            continue
+        delimiter = match.group(2)
+        entry = {'index': len(patches) + 1}
+        try:
+            args = shlex.split(match.group(3))
+        except ValueError as e:
+            args = []
+            entry['error'] = f"Could not parse arguments: {e}"
+        if len(args) >= 2:
+            entry['file'], entry['description'] = args[0], args[1]
+        elif 'error' not in entry:
+            entry['error'] = "Expected: promptpack -p FILE DESC"
+        
+        body = []
+        while i < len(lines) and lines[i] != delimiter:
+            body.append(lines[i])
+            i += 1
+        i += 1
+        # A heredoc gives every body line a trailing newline, just like stdin to -p
+        parts = split_patch_input(''.join(line + '\n' for line in body))
+        if parts is None:
+            entry.setdefault('error', "stdin must contain OLD_TEXT---SPLIT---NEW_TEXT")
+        else:
+            entry['old_text'], entry['new_text'] = parts
+        patches.append(entry)
+    return patches
+
+def _check_file_patches(filepath, patches):
+    """Simulera patcharna för en fil i ordning utan att skriva något"""
+    results = []
+    path = Path(filepath).resolve()
+    try:
+        with open(path, 'rb') as f:
+            content = decode_source(f.read())
+    except FileNotFoundError:
+        return [dict(_check_result(p), status='file_not_found', detail="File not found") for p in patches]
+    except Exception as e:
+        return [dict(_check_result(p), status='error', detail=str(e)) for p in patches]
     
-    patch = None
-    for p in history:
-        if p['id'] == patch_id:
-            patch = p
-            break
+    # Spans (start, end, patch index) of text written by earlier patches, in current coordinates
+    spans = []
+    for patch in patches:
+        result = _check_result(patch)
+        results.append(result)
+        words = patch['description'].split()
+        if len(words) > 10:
+            result.update(status='description_too_long', detail=f"Description too long ({len(words)} words, max 10)")
+            continue
+        
+        start, end, flexible, count = find_patch_match(content, patch['old_text'])
+        result['flexible_whitespace'] = flexible
+        if count == 0:
+            result.update(status='not_found', detail="Old text not found in file (even with flexible whitespace)")
+            continue
+        if count > 1:
+            result.update(status='not_unique', detail=f"Old text appears {count} times in file (must be unique)", matches=count)
+            continue
+        
+        result['line'] = content.count('\n', 0, start) + 1
+        overlaps = [index for s_start, s_end, index in spans if start < s_end and s_start < end]
+        if overlaps:
+            result.update(status='overlap', overlaps=overlaps,
+                          detail=f"Edits text written by patch {', '.join(f'#{n}' for n in overlaps)} in this block")
+        
+        new_text = patch['new_text']
+        delta = len(new_text) - (end - start)
+        content = content[:start] + new_text + content[end:]
+        shifted = []
+        for s_start, s_end, index in spans:
+            if s_start >= end:
+                shifted.append((s_start + delta, s_end + delta, index))
+            elif s_end <= start:
+                shifted.append((s_start, s_end, index))
+        shifted.append((start, start + len(new_text), patch['index']))
+        spans = shifted
+    return results
+
+def _check_result(patch):
+    return {'index': patch['index'], 'file': patch.get('file'), 'description': patch.get('description'), 'status': 'ok'}
+
+def check_patch_stream(text, max_workers=None):
+    """
+    Validera ett block med AI-patchar mot nuvarande filer utan att röra disken
+    Filer simuleras sekventiellt var för sig och oberoende filer körs parallellt
+    Returns: dict med 'patches' (en rad per patch i ordning) och 'summary'
+    """
+    patches = parse_patch_stream(text)
+    results = {}
+    by_file = {}
+    for patch in patches:
+        if 'error' in patch:
+            results[patch['index']] = dict(_check_result(patch), status='format_error', detail=patch['error'])
+        else:
+            by_file.setdefault(str(project_path(patch['file']).resolve()), []).append(patch)
     
-    if not patch:
-        return False, f"Patch #{patch_id} not found"
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for file_results in pool.map(lambda item: _check_file_patches(*item), by_file.items()):
+            for result in file_results:
+                results[result['index']] = result
     
+    ordered = [results[index] for index in sorted(results)]
+    summary = {}
+    for result in ordered:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return {'patches': ordered, 'summary': summary, 'ok': all(r['status'] == 'ok' for r in ordered)}
 
-    if patch['applied']:
-        return False, f"Patch #{patch_id} is already applied"
-    
-    filepath = Path(patch['filepath'])
-    if not filepath.exists():
-        rel_path = Path(patch['filepath']).relative_to(Path.cwd())
-        return False, f"File not found: {rel_path}"
+def select_patches_since(history, since):
+    """
+    Applicerade patchar från och med since: ett id (12 eller #12), en ISO-tidpunkt eller 'code' (senaste code.txt)
+    Returns: (patches, error)
+    """
+    since = str(since).strip()
+    if since.lstrip('#').isdigit():
+        first_id = int(since.lstrip('#'))
+        return [p for p in history if p['applied'] and p['id'] >= first_id], None
     
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        if patch['old_text'] not in content:
-            return False, f"Cannot reapply: old text not found in file"
+    if since == 'code':
+        code_files = [path for path in (project_path('code.txt'), project_path(CODE_PART_PATTERN.format(1)))
+                      if path.exists()]
+        if not code_files:
+            return None, "code.txt not found"
+        cutoff = datetime.fromtimestamp(max(path.stat().st_mtime for path in code_files))
+    else:
+        try:
+            cutoff = datetime.fromisoformat(since)
+        except ValueError:
+            return None, f"Invalid reset point: {since} (use a patch id, an ISO timestamp or 'code')"
+        if cutoff.tzinfo:
+            # Patchtider sparas i lokal tid utan zon
+            cutoff = cutoff.astimezone().replace(tzinfo=None)
+    return [p for p in history if p['applied'] and datetime.fromisoformat(p['timestamp']) >= cutoff], None
+
+def revert_patches(since, dry_run=False):
+    """
+    Ångra alla applicerade patchar sedan since, en läsning och en skrivning per fil
+    Returns: (success: bool, messages: list)
+    """
+    locked = set()
+    with contextlib.ExitStack() as locks:
+        while True:
+            history = load_patch_history()
+            selected, error = select_patches_since(history, since)
+            if error:
+                return False, [f"❌ {error}"]
+            if not selected:
+                return True, ["✅ No applied patches to revert"]
+            
+            by_file = {}
+            for patch in selected:
+                by_file.setdefault(patch['filepath'], []).append(patch)
+            if locked.issuperset(by_file):
+                break
+            # File locks in sorted order and always before the journal, same as apply_patch
+            locks.close()
+            for filepath in sorted(by_file):
+                locks.enter_context(file_lock(filepath))
+            locks.enter_context(journal_lock())
+            locked = set(by_file)
         
-        content = content.replace(patch['old_text'], patch['new_text'])
+        return _revert_locked(history, by_file, dry_run)
+
+def _revert_locked(history, by_file, dry_run):
+    """revert_patches utan låsning; anroparen håller fillåsen och journalen"""
+    messages = []
+    reverted = []
+    failed = 0
+    for filepath, patches in sorted(by_file.items()):
+        path = Path(filepath)
+        try:
+            rel_path = path.relative_to(project_root())
+        except ValueError:
+            rel_path = path
+        ids = ', '.join(f"#{p['id']}" for p in patches)
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except OSError as e:
+            messages.append(f"❌ {rel_path}\t\t{ids}: {e}")
+            failed += 1
+            continue
         
-        patch['applied'] = True
-        save_patch_history(history)
+        # Newest first, each step works on the result of the previous one
+        offsets = {}
+        error = None
+        for patch in sorted(patches, key=lambda p: p['id'], reverse=True):
+            content, offset, error = revert_patch_content(content, patch, undo=True)
+            if content is None:
+                error = f"#{patch['id']}: new {error}"
+                break
+            offsets[patch['id']] = offset
         
-        success_msg = f"Patch #{patch_id} reapplied successfully"
-        copy_to_clipboard(success_msg)
-        return True, success_msg
+        if error:
+            messages.append(f"❌ {rel_path}\t\t{ids}: {error} (file left untouched)")
+            failed += 1
+            continue
         
-    except Exception as e:
-        error_msg = f"Error: {e}"
-        copy_to_clipboard(error_msg)
-        return False, error_msg
+        if not dry_run:
+            with open(path, 'wb') as f:
+                f.write(content)
+            for patch in patches:
+                patch['applied'] = False
+                if offsets.get(patch['id']) is not None:
+                    patch['offset'] = offsets[patch['id']]
+        reverted.extend(patches)
+        verb = "Would revert" if dry_run else "Reverted"
+        messages.append(f"✅ {rel_path}\t\t{verb} {len(patches)} patch(es): {ids}")
+    
+    if reverted and not dry_run:
+        save_patch_history(history)
+    
+    verb = "would be reverted" if dry_run else "reverted"
+    messages.append(f"\n{len(reverted)} patch(es) in {len(by_file) - failed} file(s) {verb}, {failed} file(s) failed")
+    return failed == 0, messages
 
 def mark_from_promptpack(root, promptpack_paths):
     def mark_node(node):
@@ -532,7 +1846,176 @@ def mark_from_promptpack(root, promptpack_paths):
     
     mark_node(root)
 
-def build_tree(root_path, load_marks=True):
+# Enumerate from git instead of walking the working tree (--git or PROMPTPACK_GIT=1)
+GIT_ENUMERATION = os.environ.get(GIT_ENV) == '1'
+IndexStat = collections.namedtuple('IndexStat', 'st_size st_mtime_ns st_dev st_ino')
+
+def _git(args, cwd):
+    """Kör git och returnera stdout som bytes, None vid fel"""
+    PROFILER.count(subprocess=1)
+    try:
+        result = subprocess.run(['git', *args], capture_output=True, cwd=cwd)
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+def _index_varint(data, pos):
+    value = data[pos] & 127
+    while data[pos] & 128:
+        pos += 1
+        value = ((value + 1) << 7) | (data[pos] & 127)
+    return value, pos + 1
+
+def read_git_index(index_path):
+    """
+    Läs .git/index (version 2-4) utan att köra git
+    Returns: dict relpath -> IndexStat för vanliga filer, None om formatet inte stöds
+    """
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    PROFILER.count(files=1, bytes_read=len(data))
+    if data[:4] != b'DIRC':
+        return None
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in (2, 3, 4):
+        return None
+    
+    entries = {}
+    pos = 12
+    previous = b''
+    for _ in range(count):
+        start = pos
+        _, _, mtime_s, mtime_ns, dev, ino, mode, _, _, size = struct.unpack_from('>10I', data, pos)
+        flags, = struct.unpack_from('>H', data, pos + 60)
+        pos += 62
+        skip_worktree = False
+        if version >= 3 and flags & 0x4000:
+            flags2, = struct.unpack_from('>H', data, pos)
+            skip_worktree = bool(flags2 & 0x4000)
+            pos += 2
+        if version == 4:
+            strip, pos = _index_varint(data, pos)
+            end = data.index(b'\0', pos)
+            name = previous[:len(previous) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', pos)
+            name = data[pos:end]
+            pos = start + ((end - start + 8) & ~7)
+        previous = name
+        # Conflict stages, sparse entries, symlinks and submodules go through the slow path or are skipped
+        if (flags >> 12) & 3 or skip_worktree or mode >> 12 != 0o10:
+            continue
+        entries[os.fsdecode(name)] = IndexStat(size, mtime_s * 1000000000 + mtime_ns, dev, ino)
+    
+    while pos + 8 <= len(data) - 20:
+        signature = data[pos:pos + 4]
+        size, = struct.unpack_from('>I', data, pos + 4)
+        if signature in (b'link', b'sdir'):
+            return None
+        pos += 8 + size
+    return entries
+
+def _git_status(toplevel):
+    """relpath -> XY-kod för ändrade, stage:ade och ospårade filer"""
+    out = _git(['status', '--porcelain', '-z', '--untracked-files=all', '--no-renames'], toplevel)
+    if out is None:
+        return None
+    return {os.fsdecode(item[3:]): item[:2].decode() for item in out.split(b'\0') if item}
+
+def _git_toplevel(root_path):
+    out = _git(['rev-parse', '--show-toplevel'], root_path)
+    return Path(os.fsdecode(out.strip())) if out else None
+
+def git_file_list(root_path):
+    """
+    Spårade och ospårade (ej ignorerade) filer under root_path
+    Oförändrade filer tar storlek och mtime från indexet; bara ändrade filer stat:as
+    Returns: list of (Path, stat), None utanför ett git-repo
+    """
+    out = _git(['rev-parse', '--show-toplevel', '--git-path', 'index'], root_path)
+    if not out:
+        return None
+    lines = os.fsdecode(out).splitlines()
+    if len(lines) < 2:
+        return None
+    toplevel, index_path = Path(lines[0]), Path(root_path) / lines[1]
+    status = _git_status(toplevel)
+    if status is None:
+        return None
+    
+    try:
+        entries = read_git_index(index_path)
+    except (OSError, ValueError, struct.error):
+        entries = None
+    if entries is None:
+        listed = _git(['ls-files', '-z', '--cached'], toplevel)
+        if listed is None:
+            return None
+        entries = dict.fromkeys(os.fsdecode(name) for name in listed.split(b'\0') if name)
+    
+    candidates = [(rel, meta) for rel, meta in entries.items()]
+    candidates += [(rel, None) for rel, code in status.items() if code == '??']
+    files = []
+    for rel, meta in candidates:
+        path = toplevel / rel
+        if meta is None or rel in status or not meta.st_ino:
+            try:
+                meta = os.stat(path)
+            except OSError:
+                continue
+            PROFILER.count(stat=1)
+        files.append((path, meta))
+    return files
+
+def git_changed_files(root_path, since=None):
+    """
+    Modifierade, stage:ade och ospårade filer; med since allt som ändrats sedan den refen
+    Returns: set of Path, None utanför git eller vid okänd ref
+    """
+    toplevel = _git_toplevel(root_path)
+    if toplevel is None:
+        return None
+    status = _git_status(toplevel)
+    if status is None:
+        return None
+    names = [rel for rel, code in status.items() if since is None or code == '??']
+    if since:
+        out = _git(['diff', '--name-only', '-z', '--no-renames', since, '--'], toplevel)
+        if out is None:
+            return None
+        names += [os.fsdecode(name) for name in out.split(b'\0') if name]
+    return {toplevel / rel for rel in names if (toplevel / rel).is_file()}
+
+def populate_from_git(root, files):
+    """Bygg trädet från en fillista utan att gå igenom katalogerna"""
+    dirs = {root.path: root}
+    
+    def directory(path):
+        node = dirs.get(path)
+        if node is None:
+            parent = directory(path.parent)
+            node = dirs[path] = TreeNode(path, is_dir=True, parent=parent)
+            parent.children.append(node)
+        return node
+    
+    for path, meta in files:
+        try:
+            rel = path.relative_to(root.path)
+        except ValueError:
+            continue
+        if any(part.startswith('.') for part in rel.parts) or not is_text_file(path, meta):
+            continue
+        parent = directory(path.parent)
+        child = TreeNode(path, parent=parent)
+        child.size = meta.st_size
+        parent.children.append(child)
+    
+    for node in dirs.values():
+        node.children.sort(key=lambda x: (not x.is_dir, x.name.lower()))
+
+def build_tree(root_path, load_marks=True, with_index=False, git=None, progress=None):
+    """progress (en Counter) räknar upp 'entries' medan katalogerna läses, för TUI:ns skanningsvy"""
     root_path = Path(root_path).resolve()
     
     if not root_path.exists():
@@ -546,7 +2029,12 @@ def build_tree(root_path, load_marks=True):
             return
         
         try:
-            entries = sorted(node.path.iterdir(), key=lambda x: (not x.is_dir(), x.name.lower()))
+            # DirEntry: typen kommer från katalogläsningen, så varken sorteringen eller is_text_file behöver stat
+            with os.scandir(node.path) as scan:
+                entries = sorted(scan, key=lambda x: (not x.is_dir(), x.name.lower()))
+            PROFILER.count(listdir=1)
+            if progress is not None:
+                progress['entries'] += len(entries)
             for entry in entries:
                 if entry.name.startswith('.'):
                     continue
@@ -561,28 +2049,172 @@ def build_tree(root_path, load_marks=True):
         except PermissionError:
             pass
     
-    populate(root)
-    root.calculate_size()
+    if git is None:
+        git = GIT_ENUMERATION
     
-    if load_marks:
-        promptpack_paths = load_promptpack()
-        if promptpack_paths:
-            mark_from_promptpack(root, promptpack_paths)
+    with PROFILER.phase('build_tree'):
+        files = None
+        if git:
+            with PROFILER.phase('build_tree.git'):
+                files = git_file_list(root_path)
+                if files is not None:
+                    if progress is not None:
+                        progress['entries'] += len(files)
+                    populate_from_git(root, files)
+                    FILETYPE_CACHE.save()
+        if files is None:
+            with PROFILER.phase('build_tree.walk'):
+                populate(root)
+                FILETYPE_CACHE.save()
+        with PROFILER.phase('build_tree.sizes'):
+            root.calculate_size(stat=files is None)
+        
+        if load_marks:
+            with PROFILER.phase('build_tree.marks'):
+                promptpack_paths = load_promptpack()
+                if promptpack_paths:
+                    mark_from_promptpack(root, promptpack_paths)
+                mark_symbols(root, load_promptpack_symbols())
+        
+        if with_index:
+            with PROFILER.phase('build_tree.index'):
+                root.path_index = PathIndex(root)
     
     return root
 
+def root_label(root_path):
+    """Rotens sökväg relativt projektroten, som prefix i rubriker vid flera rötter"""
+    return Path(os.path.relpath(root_path, project_root())).as_posix()
+
+def build_trees(root_paths, git=None):
+    """
+    Läs flera rötter parallellt, var och en med sitt eget urval ur .promptpack
+    Filtyps- och tokencacherna delas mellan trådarna
+    Returns: list of TreeNode (None för rötter som inte finns), i samma ordning
+    """
+    def scan(root_path):
+        with project(root_path):
+            return build_tree(root_path, git=git)
+    
+    with ThreadPoolExecutor(max_workers=len(root_paths) or 1) as pool:
+        return list(pool.map(scan, [Path(path).resolve() for path in root_paths]))
+
+class PathIndex:
+    """
+    Sökindex för snabbsökning i TUI:n
+    En bitmängd per tecken ger kandidaterna direkt; en förlängd fråga filtrerar bara föregående träffar
+    """
+    def __init__(self, root):
+        self.nodes = get_file_nodes(root)
+        
+        base = root.path
+        self.paths = [str(node.path.relative_to(base)).lower() for node in self.nodes]
+        self.names = [node.name.lower() for node in self.nodes]
+        
+        size = (len(self.paths) + 7) // 8
+        masks = {}
+        for i, path in enumerate(self.paths):
+            byte, bit = i >> 3, 1 << (i & 7)
+            for ch in set(path):
+                mask = masks.get(ch)
+                if mask is None:
+                    mask = masks[ch] = bytearray(size)
+                mask[byte] |= bit
+        self.masks = {ch: int.from_bytes(mask, 'little') for ch, mask in masks.items()}
+        self.all = (1 << len(self.paths)) - 1
+        self.lengths = [len(path) for path in self.paths]
+        self.match_count = len(self.paths)
+        self._last_query = None
+        self._last_hits = None
+    
+    def _bits(self, mask):
+        bits = bin(mask)[:1:-1]
+        ids = []
+        pos = bits.find('1')
+        while pos != -1:
+            ids.append(pos)
+            pos = bits.find('1', pos + 1)
+        return ids
+    
+    def search(self, query, limit=None):
+        """
+        Fuzzy-sök (tecknen i ordning) över relativa sökvägar
+        Returns: list of TreeNode, bäst först
+        """
+        query = ''.join(query.lower().split())
+        if not query:
+            self._last_query = None
+            self.match_count = len(self.nodes)
+            return self.nodes[:limit] if limit else list(self.nodes)
+        
+        paths = self.paths
+        if self._last_query and query.startswith(self._last_query):
+            candidates = self._last_hits
+        else:
+            mask = self.all
+            for ch in set(query):
+                mask &= self.masks.get(ch, 0)
+                if not mask:
+                    break
+            candidates = self._bits(mask)
+        
+        if len(query) == 1:
+            hits = candidates
+        else:
+            # [^x]* instead of .*? keeps the subsequence match linear
+            search = re.compile(re.escape(query[0]) + ''.join(
+                f"[^{re.escape(ch)}]*{re.escape(ch)}" for ch in query[1:])).search
+            hits = [i for i in candidates if search(paths[i])]
+        self._last_query = query
+        self._last_hits = hits
+        self.match_count = len(hits)
+        
+        # Name matches first, then path substrings, then scattered matches by span; shorter paths win ties.
+        # Every tier takes only the best entries that still fit under limit
+        names = self.names
+        length = self.lengths.__getitem__
+        in_name = [i for i in hits if query in names[i]]
+        ranked = heapq.nsmallest(limit, in_name, key=length) if limit else sorted(in_name, key=length)
+        if not limit or len(ranked) < limit:
+            name_set = set(in_name)
+            in_path = [i for i in hits if i not in name_set and query in paths[i]]
+            ranked += heapq.nsmallest(limit - len(ranked), in_path, key=length) if limit else sorted(in_path, key=length)
+        if not limit or len(ranked) < limit:
+            seen = name_set.union(in_path)
+            rest = [i for i in hits if i not in seen]
+            if len(query) == 1:
+                span = length
+            else:
+                def span(i):
+                    start, end = search(paths[i]).span()
+                    return end - start, length(i)
+            ranked += heapq.nsmallest(limit - len(ranked), rest, key=span) if limit else sorted(rest, key=span)
+        return [self.nodes[i] for i in ranked]
+
 def flatten_visible_tree(root):
     visible = []
     
     def traverse(node, depth=0):
         visible.append((node, depth))
-        if node.is_dir and node.expanded:
+        if node.expanded and node.children:
             for child in node.children:
                 traverse(child, depth + 1)
     
     traverse(root)
     return visible
 
+def get_file_nodes(node, result=None):
+    if result is None:
+        result = []
+    
+    for child in node.children:
+        if child.is_dir:
+            get_file_nodes(child, result)
+        else:
+            result.append(child)
+    
+    return result
+
 def get_marked_files(node, result=None):
     if result is None:
         result = []
@@ -596,27 +2228,315 @@ def get_marked_files(node, result=None):
     
     return result
 
+def _file_matches(file_path, regex):
+    """Mappa filen och sluta vid första träffen"""
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return regex.search(mm) is not None
+    except (OSError, ValueError):
+        return False
+
+@profiled('grep_tree')
+def grep_tree(root, pattern, max_workers=None):
+    """
+    Textfilerna i trädet vars innehåll matchar regexen pattern
+    Returns: list of TreeNode i trädordning (re.error vid ogiltigt mönster)
+    """
+    regex = re.compile(pattern.encode('utf-8'))
+    nodes = get_file_nodes(root)
+    PROFILER.count(files=len(nodes))
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        found = list(pool.map(lambda node: _file_matches(node.path, regex), nodes))
+    return [node for node, hit in zip(nodes, found) if hit]
+
+def parse_imports(file_path, content):
+    """
+    Råa importer ur en fil: Python via ast, JS/TS via regex (bara relativa sökvägar)
+    Returns: list of [level, module, [names]] för Python, list of str för JS/TS
+    """
+    suffix = Path(file_path).suffix.lower()
+    if suffix in ('.py', '.pyi', '.pyw'):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            return []
+        imports = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imports.extend([0, alias.name, []] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                imports.append([node.level, node.module or '', [alias.name for alias in node.names]])
+        return imports
+    if suffix in JS_EXTENSIONS:
+        return list(dict.fromkeys(match.group(2) for match in JS_IMPORT_PATTERN.finditer(content)))
+    return []
+
+def file_imports(file_path):
+    """Importerna för en fil; cachade på mtime/storlek så oförändrade filer inte tolkas om"""
+    key = str(file_path)
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return []
+    known = IMPORT_CACHE.get(key, st)
+    if known is not None:
+        return known
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except (OSError, UnicodeDecodeError):
+        return []
+    PROFILER.count(files=1, bytes_read=len(content))
+    imports = parse_imports(file_path, content)
+    IMPORT_CACHE.put(key, st, imports)
+    return imports
+
+def _python_roots(file_path, project_root):
+    """Projektroten plus katalogen ovanför filens översta paket"""
+    top = file_path.parent
+    while (top / '__init__.py').exists() and top != project_root:
+        top = top.parent
+    return [project_root] if top == project_root else [project_root, top]
+
+def resolve_imports(file_path, imports, project_root, nodes):
+    """Mappa råa importer till filer i trädet (nodes: path -> TreeNode)"""
+    found = []
+    if file_path.suffix.lower() in JS_EXTENSIONS:
+        for spec in imports:
+            target = Path(os.path.normpath(file_path.parent / spec))
+            stem = target.with_suffix('') if target.suffix in ('.js', '.jsx', '.mjs', '.cjs') else target
+            candidates = [target] + [stem.with_name(stem.name + ext) for ext in JS_EXTENSIONS] \
+                + [target / f"index{ext}" for ext in JS_EXTENSIONS]
+            for candidate in candidates:
+                if candidate in nodes:
+                    found.append(nodes[candidate])
+                    break
+        return found
+    
+    roots = _python_roots(file_path, project_root)
+    for level, module, names in imports:
+        if level:
+            bases = [file_path.parents[level - 1]] if level <= len(file_path.parents) else []
+        else:
+            bases = roots
+        for base in bases:
+            module_dir = base.joinpath(*module.split('.')) if module else base
+            hits = [module_dir / f"{name}.py" for name in names] + [module_dir / name / '__init__.py' for name in names]
+            hits = [nodes[path] for path in hits if path in nodes]
+            for module_file in (module_dir.with_suffix('.py'), module_dir / '__init__.py'):
+                if module and module_file in nodes:
+                    hits.append(nodes[module_file])
+                    break
+            if hits:
+                found.extend(hits)
+                break
+    return found
+
+@profiled('expand_imports')
+def expand_imports(root, files, depth=None, token_budget=None):
+    """
+    Lokala beroenden (transitivt) till files som inte redan är markerade
+    depth begränsar antalet importsteg, token_budget hela urvalets storlek
+    Returns: list of TreeNode i den ordning de hittades
+    """
+    nodes = {node.path: node for node in get_file_nodes(root)}
+    
+    selected = {Path(f).resolve() for f in files}
+    total = calculate_total_tokens(list(selected)) if token_budget else 0
+    added = []
+    frontier = [path for path in selected if path in nodes]
+    level = 0
+    while frontier and (depth is None or level < depth):
+        level += 1
+        next_frontier = []
+        for path in frontier:
+            for dep in resolve_imports(path, file_imports(path), root.path, nodes):
+                if dep.path in selected:
+                    continue
+                if token_budget:
+                    tokens = calculate_total_tokens([dep.path])
+                    if total + tokens > token_budget:
+                        continue
+                    total += tokens
+                selected.add(dep.path)
+                added.append(dep)
+                next_frontier.append(dep.path)
+        frontier = next_frontier
+    IMPORT_CACHE.save()
+    return added
+
+def _ctags_symbols(file_path, lines):
+    """
+    [namn, sort, startrad, slutrad] via Universal Ctags
+    JSON ger slutrader direkt; med äldre ctags (-x) slutar en symbol före nästa symbol på samma eller lägre indrag
+    """
+    PROFILER.count(subprocess=1)
+    symbols = []
+    try:
+        result = subprocess.run(['ctags', '--output-format=json', '--fields=+neKZ', '-f', '-', str(file_path)],
+                                capture_output=True, text=True)
+        json_output = result.returncode == 0 and result.stdout.lstrip().startswith('{')
+        if json_output:
+            for line in result.stdout.splitlines():
+                try:
+                    tag = json.loads(line)
+                except ValueError:
+                    continue
+                if tag.get('_type') != 'tag' or tag.get('kind') in SYMBOL_SKIP_KINDS or not tag.get('line'):
+                    continue
+                name = f"{tag['scope']}.{tag['name']}" if tag.get('scope') else tag['name']
+                symbols.append([name, tag.get('kind', ''), tag['line'], tag.get('end')])
+        else:
+            PROFILER.count(subprocess=1)
+            result = subprocess.run(['ctags', '-x', str(file_path)], capture_output=True, text=True)
+            for line in result.stdout.splitlines():
+                parts = line.split(None, 4)
+                if len(parts) >= 4 and parts[2].isdigit() and parts[1] not in SYMBOL_SKIP_KINDS:
+                    symbols.append([parts[0], parts[1], int(parts[2]), None])
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return []
+    
+    symbols.sort(key=lambda sym: sym[2])
+    indent = lambda number: len(lines[number - 1]) - len(lines[number - 1].lstrip()) if number <= len(lines) else 0
+    for i, symbol in enumerate(symbols):
+        if symbol[3] is None:
+            end = len(lines)
+            for later in symbols[i + 1:]:
+                if later[2] > symbol[2] and indent(later[2]) <= indent(symbol[2]):
+                    end = later[2] - 1
+                    break
+            symbol[3] = end
+        symbol[3] = max(symbol[2], min(symbol[3], len(lines)))
+        while symbol[3] > symbol[2] and not lines[symbol[3] - 1].strip():
+            symbol[3] -= 1
+    return symbols
+
+def file_symbols(file_path):
+    """Symboltabellen för en fil, cachad på mtime/storlek; Returns: list of [name, kind, start, end]"""
+    key = str(file_path)
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return []
+    known = SYMBOL_CACHE.get(key, st)
+    if known is not None:
+        return known
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except (OSError, UnicodeDecodeError):
+        return []
+    PROFILER.count(files=1, bytes_read=len(content))
+    symbols = _ctags_symbols(file_path, LINE_PATTERN.findall(content))
+    SYMBOL_CACHE.put(key, st, symbols)
+    return symbols
+
+def _symbol_matches(symbol, names):
+    return symbol in names or symbol.rsplit('.', 1)[-1] in names
+
+def symbol_ranges(file_path, names):
+    """
+    Sammanslagna radintervall (1-baserade, inklusive) för de valda symbolerna
+    Returns: (ranges, saknade namn)
+    """
+    found = set()
+    ranges = []
+    for symbol, _, start, end in file_symbols(file_path):
+        if _symbol_matches(symbol, names):
+            found.update(name for name in names if name in (symbol, symbol.rsplit('.', 1)[-1]))
+            ranges.append((start, end))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged, sorted(set(names) - found)
+
+def expand_symbols(node):
+    """Fäll ut en fil i sina symboler (tabellen är cachad, så det går direkt för oförändrade filer)"""
+    node.children = [SymbolNode(node, *symbol) for symbol in file_symbols(node.path)]
+    node.expanded = bool(node.children)
+    return node.expanded
+
+def get_symbol_marks(root):
+    """Filer med valda symboler men inte hela filen; Returns: dict Path -> set of names"""
+    return {node.path: set(node.symbol_marks) for node in get_file_nodes(root)
+            if node.symbol_marks and not node.marked}
+
+def mark_symbols(root, symbol_marks):
+    for node in get_file_nodes(root):
+        names = symbol_marks.get(node.path.resolve())
+        if names and not node.marked:
+            node.symbol_marks = set(names)
+
+def save_selection(root):
+    save_promptpack(get_marked_files(root), get_symbol_marks(root))
+
+# (path, mtime_ns, size, names) -> tokens for the selected ranges
+_SYMBOL_TOKENS = {}
+
+def symbol_selection_tokens(symbol_marks):
+    total = 0
+    for path, names in symbol_marks.items():
+        try:
+            st = os.stat(path)
+            key = (str(path), st.st_mtime_ns, st.st_size, frozenset(names))
+            if key not in _SYMBOL_TOKENS:
+                _SYMBOL_TOKENS[key] = sum(count_tokens_cached(text) for _, text in symbol_texts(path, names)[0])
+            total += _SYMBOL_TOKENS[key]
+        except (OSError, UnicodeDecodeError):
+            pass
+    return total
+
+def symbol_texts(file_path, names):
+    """Returns: ([(\"start-end\", text)], saknade namn)"""
+    ranges, missing = symbol_ranges(file_path, names)
+    content, _ = read_text_hashed(file_path)
+    lines = LINE_PATTERN.findall(content)
+    texts = []
+    for start, end in ranges:
+        text = ''.join(lines[start - 1:end])
+        if not text.endswith('\n'):
+            text += '\n'
+        texts.append((f"{start}-{end}", text))
+    return texts, missing
+
+def mark_dependencies(root, depth=0, token_budget=None):
+    """Markera importerna till trädets markerade filer (depth 0 = obegränsat) och skriv ut vad som lades till"""
+    added = expand_imports(root, get_marked_files(root), depth or None, token_budget)
+    for node in added:
+        node.marked = True
+        print(f"   + {node.path.relative_to(root.path)}")
+    if added:
+        print(f"🔗 Added {len(added)} imported file(s)")
+    return added
+
 def calculate_total_tokens(marked_files):
     total_tokens = 0
     for file_path in marked_files:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                total_tokens += calculate_tokens(content)
+            total_tokens += file_tokens(file_path)
         except:
             pass
     return total_tokens
 
+@profiled('write_project_tree')
 def write_project_tree(out, root):
     """Skriv ut projektstruktur med tree-kommandot om det finns, annars manuellt"""
     # Försök använda tree-kommandot först
     try:
         # Kör tree-kommandot (exkludera dolda filer)
+        PROFILER.count(subprocess=1)
         result = subprocess.run(
             ['tree', '--noreport', '--charset=utf8', '.'],
             capture_output=True,
             text=True,
-            cwd=Path.cwd()
+            cwd=root.path
         )
         if result.returncode == 0:
             out.write(result.stdout)
@@ -641,99 +2561,231 @@ def write_project_tree(out, root):
     
     write_tree_manual(root)
 
-def show_patch_history(stdscr):
-    """Visa patch historik och tillåt unpatch/repatch"""
-    curses.curs_set(0)
-    history = load_patch_history()
+class PatchHistoryView:
+    """
+    Virtualiserad patchlista över ett PatchIndex: bara synliga rader läses, formateras och ritas
+    Filter: fritext, file:NAMN, status:applied|unapplied, since:DATUM, until:DATUM
+    """
+    def __init__(self, index):
+        self.index = index
+        self.filtered = list(range(len(index)))
+        self.query = ""
+        self.terms = []
+        self.selected = 0
+        self.scroll = 0
+        self.message = None
     
-    if not history:
-        stdscr.clear()
-        stdscr.addstr(0, 0, "No patches in history", curses.A_BOLD)
-        stdscr.addstr(2, 0, "Press any key to return...")
-        stdscr.refresh()
-        stdscr.getch()
-        return
+    def _matches(self, idx, terms):
+        row = self.index.row(idx)
+        haystack = None
+        for key, value in terms:
+            if key == 'file':
+                if value not in row[4].lower():
+                    return False
+            elif key == 'status':
+                status = 'applied' if row[1] else 'unapplied'
+                if not status.startswith(value):
+                    return False
+            elif key == 'since':
+                if row[2][:len(value)] < value:
+                    return False
+            elif key == 'until':
+                if row[2][:len(value)] > value:
+                    return False
+            else:
+                if haystack is None:
+                    haystack = f"{row[3]}\t{os.path.basename(row[4])}".lower()
+                if value not in haystack:
+                    return False
+        return True
     
-    selected = 0
-    scroll = 0
+    def set_query(self, query):
+        """Inkrementell filtrering; en förlängd fråga filtrerar bara föregående träffar"""
+        terms = []
+        for word in query.lower().split():
+            key, sep, value = word.partition(':')
+            if sep and key in ('file', 'status', 'since', 'until'):
+                terms.append((key, value))
+            else:
+                terms.append(('text', word))
+        
+        # A term that only grew (same kind, longer value) can only narrow the result
+        narrowing = len(terms) >= len(self.terms) and all(
+            new[0] == old[0] and new[1].startswith(old[1]) for old, new in zip(self.terms, terms))
+        candidates = self.filtered if narrowing else range(len(self.index))
+        current = self.filtered[self.selected] if self.filtered else None
+        self.filtered = [idx for idx in candidates if self._matches(idx, terms)]
+        self.query = query
+        self.terms = terms
+        
+        self.selected = 0
+        if current is not None and self.filtered:
+            self.selected = max(0, min(bisect.bisect_left(self.filtered, current), len(self.filtered) - 1))
     
-    while True:
-        stdscr.clear()
+    def jump_to_id(self, patch_id):
+        position = self.index.find(patch_id)
+        if position is None:
+            return False
+        pos = bisect.bisect_left(self.filtered, position)
+        if pos < len(self.filtered) and self.filtered[pos] == position:
+            self.selected = pos
+            return True
+        return False
+    
+    def reload(self):
+        index = load_patch_index()
+        if index is None:
+            return
+        self.index.close()
+        self.index = index
+        self.filtered = list(range(len(index)))
+        self.terms = []
+        self.set_query(self.query)
+    
+    def move(self, delta):
+        if self.filtered:
+            self.selected = max(0, min(len(self.filtered) - 1, self.selected + delta))
+    
+    def _format_row(self, row):
+        status = "✓ Applied " if row[1] else "○ Unapplied"
+        return f"{row[0]:<5} {status:<10} {row[2]:<20} {row[3][:60]:<60} {Path(row[4]).name}"
+    
+    def draw(self, stdscr, prompt=None):
+        stdscr.erase()
         height, width = stdscr.getmaxyx()
+        display_height = max(1, height - 3)
         
-        title = "Patch History - ↑↓: Navigate | Space: Toggle | q: Back"
-        stdscr.addstr(0, 0, title.ljust(width-1)[:width-1], curses.A_REVERSE)
+        if self.selected < self.scroll:
+            self.scroll = self.selected
+        elif self.selected >= self.scroll + display_height:
+            self.scroll = self.selected - display_height + 1
         
-        header = f"{'ID':<5} {'Status':<10} {'Date':<20} {'Description':<60} {'File'}"
+        title = "Patch History - ↑↓/PgUp/PgDn: Navigate | Space: Toggle | /: Filter | g: Go to id | q: Back"
         try:
+            stdscr.addstr(0, 0, title.ljust(width-1)[:width-1], curses.A_REVERSE)
+            header = f"{'ID':<5} {'Status':<10} {'Date':<20} {'Description':<60} {'File'}"
             stdscr.addstr(1, 0, header[:width-1], curses.A_BOLD)
         except curses.error:
             pass
         
-        display_height = height - 3
-        for i in range(display_height):
-            idx = scroll + i
-            if idx >= len(history):
-                break
-            
-            patch = history[idx]
-            status = "✓ Applied " if patch['applied'] else "○ Unapplied"
-            date = patch['timestamp'][:19].replace('T', ' ')
-            desc = patch['description'][:60]
-            filepath = Path(patch['filepath']).name
-            
-            line = f"{patch['id']:<5} {status:<10} {date:<20} {desc:<60} {filepath}"
-            
-            attr = curses.A_REVERSE if idx == selected else curses.A_NORMAL
-            if patch['applied']:
+        for i, idx in enumerate(self.filtered[self.scroll:self.scroll + display_height]):
+            row = self.index.row(idx)
+            attr = curses.A_REVERSE if self.scroll + i == self.selected else curses.A_NORMAL
+            if row[1]:
                 attr |= curses.color_pair(1)
-            
             try:
-                stdscr.addstr(i + 2, 0, line[:width-1], attr)
+                stdscr.addstr(i + 2, 0, self._format_row(row)[:width-1], attr)
             except curses.error:
                 pass
         
+        if prompt is not None:
+            status, attr = prompt, curses.A_BOLD
+        elif self.message:
+            status, attr = self.message
+        else:
+            status = f"{len(self.filtered):,} of {len(self.index):,} patches"
+            if self.query:
+                status += f" | filter: {self.query}"
+            attr = curses.A_REVERSE
+        try:
+            stdscr.addstr(height - 1, 0, status.ljust(width-1)[:width-1], attr)
+        except curses.error:
+            pass
+        stdscr.refresh()
+    
+    def toggle_selected(self):
+        """Växla vald patch och uppdatera bara dess rad"""
+        if not self.filtered:
+            return
+        row = self.index.row(self.filtered[self.selected])
+        if row[1]:
+            success, msg = unapply_patch(row[0])
+        else:
+            success, msg = reapply_patch(row[0])
+        if not self.index.current():
+            # Indexet byggdes om (eller patch.json ändrades utifrån): öppna det nya och filtrera om
+            self.reload()
+        color = curses.color_pair(1) if success else curses.color_pair(2)
+        self.message = (msg, color | curses.A_BOLD)
+
+def _read_prompt(stdscr, view, label, initial="", on_change=None):
+    """Radinmatning i statusraden; on_change anropas vid varje tangent. Returnerar None vid Esc"""
+    text = initial
+    while True:
+        view.draw(stdscr, prompt=f"{label}{text}")
+        key = stdscr.get_wch() if hasattr(stdscr, 'get_wch') else stdscr.getch()
+        if key in ('\n', '\r', curses.KEY_ENTER, 10, 13):
+            return text
+        if key in ('\x1b', 27):
+            return None
+        if key in (curses.KEY_BACKSPACE, '\x7f', '\b', 127, 8):
+            text = text[:-1]
+        elif isinstance(key, str) and key.isprintable():
+            text += key
+        elif isinstance(key, int) and 32 <= key < 127:
+            text += chr(key)
+        else:
+            continue
+        if on_change:
+            on_change(text)
+
+def show_patch_history(stdscr):
+    """Visa patch historik och tillåt unpatch/repatch"""
+    curses.curs_set(0)
+    index = load_patch_index()
+    
+    if not index:
+        stdscr.clear()
+        stdscr.addstr(0, 0, "No patches in history", curses.A_BOLD)
+        stdscr.addstr(2, 0, "Press any key to return...")
         stdscr.refresh()
+        stdscr.getch()
+        return
+    
+    view = PatchHistoryView(index)
+    
+    while True:
+        view.draw(stdscr)
+        height, _ = stdscr.getmaxyx()
+        page = max(1, height - 3)
         key = stdscr.getch()
+        view.message = None
         
         if key == ord('q') or key == ord('Q'):
             break
         elif key == curses.KEY_UP:
-            selected = max(0, selected - 1)
-            if selected < scroll:
-                scroll = selected
+            view.move(-1)
         elif key == curses.KEY_DOWN:
-            selected = min(len(history) - 1, selected + 1)
-            if selected >= scroll + display_height:
-                scroll = selected - display_height + 1
+            view.move(1)
+        elif key == curses.KEY_PPAGE:
+            view.move(-page)
+        elif key == curses.KEY_NPAGE:
+            view.move(page)
+        elif key == curses.KEY_HOME:
+            view.move(-len(view.filtered))
+        elif key == curses.KEY_END:
+            view.move(len(view.filtered))
+        elif key == ord('/'):
+            previous = view.query
+            result = _read_prompt(stdscr, view, "Filter: ", previous, on_change=view.set_query)
+            if result is None:
+                view.set_query(previous)
+        elif key == ord('g'):
+            result = _read_prompt(stdscr, view, "Go to id: ")
+            if result and result.strip().lstrip('#').isdigit():
+                if not view.jump_to_id(int(result.strip().lstrip('#'))):
+                    view.message = (f"Patch #{result.strip()} not in current list", curses.color_pair(2) | curses.A_BOLD)
         elif key == ord(' '):
-            patch = history[selected]
-            
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Processing...", curses.A_BOLD)
-            stdscr.refresh()
-            
-            if patch['applied']:
-                success, msg = unapply_patch(patch['id'])
-            else:
-                success, msg = reapply_patch(patch['id'])
-            
-            history = load_patch_history()
-            
-            stdscr.clear()
-            color = curses.color_pair(1) if success else curses.color_pair(2)
-            stdscr.addstr(0, 0, msg, color | curses.A_BOLD)
-            stdscr.addstr(2, 0, "Press any key to continue...")
-            stdscr.refresh()
-            stdscr.getch()
+            view.toggle_selected()
 
-def draw_tree(stdscr, root, selected_idx, scroll_offset):
-    stdscr.clear()
+def draw_tree(stdscr, root, selected_idx, scroll_offset, prompt=None, status=None):
+    """status ersätter den synkront räknade statusraden (main skickar BackgroundWork.status)"""
+    stdscr.erase()
     height, width = stdscr.getmaxyx()
     
     visible_nodes = flatten_visible_tree(root)
     
-    title = "↑↓: Navigate | ←→: Expand | Space: Mark | F1: code | F2: ctags | F12: patches | q: Quit"
+    title = "↑↓: Navigate | ←→: Expand | Space: Mark | /: Find | g: Grep | d: Deps | c: Changed | F1: code | F2: ctags | F12: patches | q: Quit"
     stdscr.addstr(0, 0, title.ljust(width-1)[:width-1], curses.A_REVERSE)
     
     display_height = height - 2
@@ -749,13 +2801,15 @@ def draw_tree(stdscr, root, selected_idx, scroll_offset):
         
         if node.is_dir:
             icon = "▶ " if not node.expanded else "▼ "
+        elif node.expanded:
+            icon = "▼ "
         else:
             icon = "  "
         
         if node.marked:
             mark = "[✓] "
             mark_color = curses.color_pair(1)
-        elif node.is_dir and node.has_partial_marks():
+        elif node.has_partial_marks():
             mark = "[◐] "
             mark_color = curses.color_pair(2)
         else:
@@ -788,29 +2842,261 @@ def draw_tree(stdscr, root, selected_idx, scroll_offset):
         except curses.error:
             pass
     
-    marked_files = get_marked_files(root)
-    total_tokens = calculate_total_tokens(marked_files)
+    if status is None and not prompt:
+        marked_files = get_marked_files(root)
+        total_tokens = calculate_total_tokens(marked_files)
+        symbol_marks = get_symbol_marks(root)
+        
+        status = f"Marked: {len(marked_files)} files"
+        if symbol_marks:
+            total_tokens += symbol_selection_tokens(symbol_marks)
+            status += f", {sum(len(names) for names in symbol_marks.values())} symbols"
+        status = f"{status} | Tokensize: {total_tokens:,} tokens"
+    status = prompt or status
+    try:
+        stdscr.addstr(height - 1, 0, status[:width-1], curses.A_REVERSE)
+    except curses.error:
+        pass
+    
+    stdscr.refresh()
+
+COMPACT_LANGUAGES = {
+    '.py': 'python', '.pyi': 'python', '.pyw': 'python',
+    '.js': 'js', '.jsx': 'js', '.mjs': 'js', '.cjs': 'js', '.ts': 'js', '.tsx': 'js', '.mts': 'js', '.cts': 'js',
+    '.c': 'c', '.h': 'c', '.cc': 'c', '.cpp': 'c', '.cxx': 'c', '.hh': 'c', '.hpp': 'c', '.hxx': 'c',
+    '.java': 'c', '.cs': 'c', '.go': 'c', '.rs': 'c', '.swift': 'c', '.kt': 'c', '.scala': 'c', '.m': 'c'
+}
+LICENSE_PATTERN = re.compile(r'copyright|licen[cs]e|spdx-|all rights reserved|permission is hereby granted', re.IGNORECASE)
+BANNER_PATTERNS = {
+    'python': re.compile(r'^\s*#[\s#=\-*~_+/<>.]{9,}$'),
+    'js': re.compile(r'^\s*(//[\s/=\-*~_+#<>.]{8,}|/\*[\s=\-*~_+#<>.]{6,}\*/|\*[\s=\-*~_+#<>.]{9,})$'),
+    'c': re.compile(r'^\s*(//[\s/=\-*~_+#<>.]{8,}|/\*[\s=\-*~_+#<>.]{6,}\*/|\*[\s=\-*~_+#<>.]{9,})$')
+}
+COMPACT_NOTE = """
+Compacted files:
+Some files below have been compacted to save tokens: license headers, comment banners, trailing whitespace and repeated blank lines are removed.
+When lines were removed, the header is followed by a line map such as [line map: 1→21, 5→30], meaning output line 1 is line 21 of the real file and output line 5 is line 30, counting on from there.
+Use real line numbers with promptpack -n, and never put removed comments or blank lines in old_text.
+
+"""
+
+SYMBOL_NOTE = """
+Some files are only partially included: a header in the form ### ./relative/path:start-end holds just those lines of the file.
+Line numbers are the file's real line numbers, the same as promptpack -n start,end relative/path shows.
+Patches still use the plain path (promptpack -p "relative/path"), and old_text must lie within the included lines.
+
+"""
+
+MULTI_ROOT_NOTE = """
+Multiple project roots:
+This package spans several sibling projects. Every path starts with its project's directory, e.g. ### ./billing/src/app.py, and each project's structure is listed separately.
+Run promptpack commands from the directory that contains these projects, using the same paths as the headers.
+
+"""
+
+def _license_header(lines, language):
+    """Radintervall (start, slut) för en inledande licenskommentar, eller (0, 0)"""
+    start = 0
+    while start < len(lines) and (not lines[start].strip() or lines[start].startswith('#!')
+                                  or (language == 'python' and re.match(r'^#.*coding[:=]', lines[start]))):
+        start += 1
+    if start >= len(lines):
+        return 0, 0
+    
+    end = start
+    first = lines[start].lstrip()
+    if language == 'python' or first.startswith('//'):
+        marker = '#' if language == 'python' else '//'
+        while end < len(lines) and lines[end].lstrip().startswith(marker):
+            end += 1
+    elif first.startswith('/*'):
+        while end < len(lines) and '*/' not in lines[end]:
+            end += 1
+        if end >= len(lines):
+            # Kommentaren stängs aldrig: inget licenshuvud, annars försvinner hela filen
+            return 0, 0
+        end += 1
+    
+    if end > start and LICENSE_PATTERN.search('\n'.join(lines[start:end])):
+        return start, end
+    return 0, 0
+
+# Strängtokens som kan spänna över flera rader (f- och t-strängar är egna tokens från Python 3.12/3.14)
+PY_STRING_SPANS = {getattr(tokenize, start): getattr(tokenize, end)
+                   for start, end in (('FSTRING_START', 'FSTRING_END'), ('TSTRING_START', 'TSTRING_END'))
+                   if hasattr(tokenize, start)}
+C_STRING_TOKENS = re.compile(r'//|/\*|\*/|\\[\s\S]|[\'"`\n]')
+
+def _python_string_lines(content):
+    """Radnummer som börjar eller slutar inne i en Python-sträng, enligt tokenize"""
+    rows = set()
+    open_rows = []
+    last_row = 1
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(content).readline):
+            last_row = token.start[0]
+            if token.type == tokenize.STRING:
+                start = token.start[0]
+            elif token.type in PY_STRING_SPANS:
+                open_rows.append(token.start[0])
+                continue
+            elif open_rows and token.type in PY_STRING_SPANS.values():
+                start = open_rows.pop()
+            else:
+                continue
+            if token.end[0] > start:
+                rows.update(range(start, token.end[0] + 1))
+    except (tokenize.TokenError, SyntaxError):
+        # Går inte att tokenisera härifrån: rör inget från sista kända token och framåt
+        rows.update(range(last_row, content.count('\n') + 2))
+    return rows
+
+def _c_string_lines(content, language):
+    """
+    Radnummer som börjar eller slutar inne i en sträng för JS/C-lika språk
+    Liten tillståndsmaskin över kommentarer och '...', "..." och `...`; '...' slutar vid radbrytning.
+    I JS slutar även "..." vid radbrytning, så ett regex som /"/ inte vänder resten av filen.
+    """
+    rows = set()
+    multiline = '"`' if language == 'c' else '`'
+    state = None
+    row = 1
+    for match in C_STRING_TOKENS.finditer(content):
+        token = match.group()
+        if token == '\n' or token == '\\\n':
+            if (state in ('"', '`') and state in multiline) or (token != '\n' and state in ('\'', '"')):
+                rows.update((row, row + 1))
+            elif state in ('//', '\'', '"'):
+                state = None
+            row += 1
+        elif state is None:
+            if token in ('//', '/*', '\'', '"', '`'):
+                state = token
+        elif token == state or (state == '/*' and token == '*/'):
+            state = None
+    return rows
+
+def compact_source(content, language):
+    """
+    Ta bort licenshuvud, kommentarsbanners, avslutande blanksteg och upprepade tomrader
+    Returns: (compacted_text, line_map) där line_map är originalradnumret för varje utrad
+    """
+    lines = content.split('\n')
+    trailing_newline = content.endswith('\n')
+    if trailing_newline:
+        lines.pop()
+    
+    header_start, header_end = _license_header(lines, language)
+    banner = BANNER_PATTERNS[language]
+    # Rader i flerradiga strängar är programtext, inte kommentarer eller blanksteg
+    in_string = _python_string_lines(content) if language == 'python' else _c_string_lines(content, language)
+    kept = []
+    line_map = []
+    previous_blank = True
+    for number, line in enumerate(lines, start=1):
+        if header_start < number <= header_end:
+            continue
+        if number in in_string:
+            kept.append(line)
+            line_map.append(number)
+            previous_blank = False
+            continue
+        line = line.rstrip()
+        if not line:
+            if previous_blank:
+                continue
+            previous_blank = True
+        else:
+            if banner.match(line):
+                continue
+            previous_blank = False
+        kept.append(line)
+        line_map.append(number)
     
-    status = f"Marked: {len(marked_files)} files | Tokensize: {total_tokens:,} tokens"
-    try:
-        stdscr.addstr(height - 1, 0, status[:width-1], curses.A_REVERSE)
-    except curses.error:
-        pass
+    while kept and not kept[-1] and line_map[-1] not in in_string:
+        kept.pop()
+        line_map.pop()
     
-    stdscr.refresh()
+    text = '\n'.join(kept)
+    if trailing_newline and kept:
+        text += '\n'
+    return text, line_map
 
-def create_code_file(root):
-    marked_files = get_marked_files(root)
+def format_line_map(line_map):
+    """Komprimera radmappningen till segment 'utrad→originalrad' där rader hoppats över"""
+    segments = []
+    for out_line, orig_line in enumerate(line_map, start=1):
+        if out_line == 1 or orig_line != line_map[out_line - 2] + 1:
+            segments.append(f"{out_line}→{orig_line}")
+    if segments == ['1→1']:
+        return None
+    return ', '.join(segments)
+
+@profiled('create_code_file')
+def create_code_file(root, compact=False, report=None, split_tokens=None, parts=None, manifest=False,
+                     caps=None, truncated=None, summary=None, out_dir=None, output=None, compression=None):
+    """
+    Skapa code.txt av markerade filer i out_dir (standard: projektroten)
+    root kan vara en lista av träd (se build_trees); sökvägarna blir då relativa projektroten, t.ex. ./billing/src/app.py
+    compact=True komprimerar kända språk; report fylls då med (rel_path, tokens_före, tokens_efter)
+    split_tokens delar upp paketet i code.partN.txt som var och en ryms i budgeten; parts fylls med en rad per del
+    manifest=True skriver även code.manifest.json; summary (dict) fylls med samma innehåll
+    caps är en lista av parse_cap-gränser per fil; truncated fylls med de filer som kortades
+    output ('-' för stdout, en fil eller pipe) strömmar paketet dit i stället för code.txt, se open_output
+    """
+    marked_files = []
+    symbol_marks = {}
+    for tree in root if isinstance(root, list) else [root]:
+        marked_files += get_marked_files(tree)
+        symbol_marks.update(get_symbol_marks(tree))
     
-    if not marked_files:
+    if not marked_files and not symbol_marks:
         return False
     
-    marked_files = sorted(marked_files, key=lambda x: str(x))
+    marked_files = sorted(marked_files + list(symbol_marks), key=lambda x: str(x))
+    sections = _code_sections(marked_files, compact, report, with_tokens=bool(split_tokens),
+                              symbol_marks=symbol_marks, caps=caps, truncated=truncated)
+    
+    out_dir = Path(out_dir) if out_dir else project_root()
+    entries = [] if manifest or summary is not None else None
+    preamble = io.StringIO()
+    _write_code_preamble(preamble, root, compact, bool(symbol_marks))
+    
+    if split_tokens and not output:
+        written, files = write_code_parts(preamble.getvalue(), sections, split_tokens, entries, out_dir)
+        if parts is not None:
+            parts.extend(written)
+    else:
+        if output:
+            target, name = open_output(output, compression), 'stdout' if output == '-' else Path(output).name
+        else:
+            target, name = open(out_dir / 'code.txt', 'w', encoding='utf-8'), 'code.txt'
+        with target as out:
+            writer = PackageWriter(out, name, entries)
+            writer.write(preamble.getvalue())
+            for rel_path, content, line_map, _, _ in sections:
+                writer.section(rel_path, _section_header(rel_path, line_map), content)
+        files = [writer.summary()]
+        if output and output_compression(output, compression):
+            # Offset och längd gäller den okomprimerade texten; man kan inte söka direkt i den komprimerade filen
+            files[0].update(compression=output_compression(output, compression), offsets='uncompressed')
     
-    with open('code.txt', 'w', encoding='utf-8') as out:
-        out.write("""The following instructions apply if command #patch is given:
+    if entries is not None:
+        data = build_manifest(files, entries)
+        if manifest:
+            write_manifest('code', data, out_dir)
+        if summary is not None:
+            summary.update(data)
+    if not manifest and not output:
+        remove_manifest('code', out_dir)
+    return True
+
+def _write_code_preamble(out, root, compact, symbols=False):
+    """Instruktionerna och projektstrukturen som inleder code.txt; root kan vara en lista av rötter"""
+    out.write("""The following instructions apply if command #patch is given:
 Analyze the attached text document with collected source code which is only a compilation, not a target file.
 Interpretation of target file should be done via headers in the form ### ./relative/path.
+A file whose content is only "(identical to ./other/path)" has exactly the same content as that earlier file.
 
 If a file exists in the project structure below but is not included in this document, and you need to see it to complete the task, ask for that file before proceeding and it will be given to you.
 
@@ -908,25 +3194,330 @@ Fallback:
 If you find yourself not being able to solve an issue, trying multiple times and coming to the conclusion that you're stuck do not write a patch to restore the code back to the state of code.txt.
 Instead let user know that you want to #reset the code and if there are any patches produced in the conversation that are of importance/use, number each patch and instruct user to apply them after resetting the code, for example;
 We're not getting anywhere, please #reset the code and apply #patch 2, 9, 12, 13 and 22. Let me know when you are ready and we can proceed.
-
-## Project Structure
 """)
+    roots = root if isinstance(root, list) else [root]
+    notes = [note for note, wanted in ((COMPACT_NOTE, compact), (SYMBOL_NOTE, symbols),
+                                       (MULTI_ROOT_NOTE, len(roots) > 1)) if wanted]
+    out.write(notes[0] if notes else "\n")
+    for note in notes[1:]:
+        out.write(note.lstrip("\n"))
+    out.write("## Project Structure\n")
+    
+    if len(roots) == 1:
+        write_project_tree(out, roots[0])
+    else:
+        for tree in roots:
+            out.write(f"\n./{root_label(tree.path)}/\n")
+            write_project_tree(out, tree)
+    out.write("\n")
+
+def _estimate_tokens(text):
+    """Snål överskattning för korta rubriker och innehållsrader, så de slipper tokeniseras"""
+    return len(text) // 3 + 1
+
+def _line_count(content):
+    return content.count('\n') + (0 if not content or content.endswith('\n') else 1)
+
+def _code_sections(marked_files, compact, report, with_tokens=False, symbol_marks=None, caps=None, truncated=None):
+    """
+    En sektion per markerad fil: (rel_path, text, line_map, tokens, total_lines)
+    line_map är originalraden för varje utrad (None = oförändrad), tokens bara om with_tokens
+    Filer i symbol_marks ger en sektion per radintervall med rubriken ./path:start-end
+    Filer över sin gräns i caps kortas till början och slut; truncated fylls då med (rel_path, first, last, total)
+    """
+    seen = {}
+    for file_path in marked_files:
+        rel_path = file_path.relative_to(project_root())
+        if symbol_marks and file_path in symbol_marks:
+            yield from _symbol_sections(file_path, rel_path, symbol_marks[file_path], with_tokens)
+            continue
+        cap = cap_for(rel_path, caps)
+        capped = None
+        try:
+            with PROFILER.phase('create_code_file.read', trace=False):
+                if cap:
+                    capped = read_capped(file_path, cap, rel_path)
+                if capped:
+                    content, cap_map, capped_total, omitted = capped
+                    digest = content_hash(content)
+                    if truncated is not None:
+                        truncated.append((rel_path, omitted[0], omitted[1], capped_total))
+                else:
+                    content, digest = read_text_hashed(file_path)
+        except Exception as e:
+            note = f"# Error reading file: {e}\n"
+            yield rel_path, note, None, _estimate_tokens(note), None
+            continue
         
-                
-        write_project_tree(out, root)
-        out.write("\n")
-        for file_path in marked_files:
-            rel_path = file_path.relative_to(Path.cwd())
-            out.write(f"\n### ./{rel_path}\n\n")
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    out.write(f.read())
-            except Exception as e:
-                out.write(f"# Error reading file: {e}\n")
+        reference = f"(identical to ./{seen.get(digest)})\n"
+        if digest in seen and len(content) > len(reference):
+            yield rel_path, reference, None, _estimate_tokens(reference), None
+            continue
+        seen.setdefault(digest, rel_path)
+        
+        total_lines = _line_count(content)
+        line_map = None
+        if capped:
+            total_lines, line_map = capped_total, cap_map
+        language = COMPACT_LANGUAGES.get(file_path.suffix.lower()) if compact else None
+        if language:
+            with PROFILER.phase('compact', trace=False):
+                compacted, compact_map = compact_source(content, language)
+                line_map = [line_map[number - 1] for number in compact_map] if line_map else compact_map
+            if report is not None:
+                report.append((rel_path, count_tokens_cached(content, digest), count_tokens_cached(compacted)))
+            content, digest = compacted, None
+        tokens = count_tokens_cached(content, digest) if with_tokens else None
+        yield rel_path, content, line_map, tokens, total_lines
+
+class PackageWriter:
+    """
+    Skriver en paketfil och, om entries inte är None, en manifestpost per sektion
+    Offset och längd är i byte (UTF-8) så att nedströmsverktyg kan söka direkt till en sektion
+    """
+    def __init__(self, out, filename, entries=None):
+        self.out = out
+        self.filename = filename
+        self.entries = entries
+        self.offset = 0
+        self.tokens = collections.Counter()
     
-    return True
+    def write(self, text):
+        self.out.write(text)
+        if self.entries is not None:
+            self.offset += len(text.encode('utf-8'))
+            for encoding in _manifest_encodings():
+                self.tokens[encoding] += count_tokens_cached(text, encoding=encoding)
+    
+    def section(self, rel_path, header, content, line_range=None):
+        if self.entries is None:
+            self.out.write(header)
+            self.out.write(content)
+            return
+        header_offset = self.offset
+        self.out.write(header)
+        self.offset += len(header.encode('utf-8'))
+        for encoding in _manifest_encodings():
+            self.tokens[encoding] += count_tokens_cached(header, encoding=encoding)
+        digest = content_hash(content)
+        entry = {
+            'path': str(rel_path),
+            'file': self.filename,
+            'header_offset': header_offset,
+            'offset': self.offset,
+            'length': len(content.encode('utf-8')),
+            'lines': _line_count(content),
+            'hash': f"blake2b:{digest}",
+            'tokens': count_tokens_cached(content, digest),
+        }
+        if line_range:
+            entry['line_range'] = list(line_range)
+        self.entries.append(entry)
+        self.out.write(content)
+        self.offset += entry['length']
+        for encoding in _manifest_encodings():
+            self.tokens[encoding] += count_tokens_cached(content, digest, encoding)
+    
+    def summary(self):
+        return {'name': self.filename, 'bytes': self.offset, 'tokens': dict(self.tokens)}
+
+def _manifest_encodings():
+    return sorted({encoding for _, _, encoding in MODELS})
+
+def build_manifest(files, sections):
+    """
+    Manifestet: per sektion offset/längd/rader/hash/tokens, plus totaler och passform per modell
+    Passformen avser den största filen, eftersom varje del skickas för sig
+    """
+    largest = collections.Counter()
+    for package_file in files:
+        for encoding, tokens in package_file['tokens'].items():
+            largest[encoding] = max(largest[encoding], tokens)
+    manifest = {
+        'version': 1,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'root': str(project_root()),
+        'encoding': DEFAULT_ENCODING,
+        'files': files,
+        'sections': sections,
+        'totals': {
+            'files': len(files),
+            'sections': len(sections),
+            'bytes': sum(package_file['bytes'] for package_file in files),
+            'tokens': sum(package_file['tokens'].get(DEFAULT_ENCODING, 0) for package_file in files),
+        },
+        'models': [{'name': model, 'limit': limit, 'encoding': encoding, 'tokens': largest[encoding],
+                    'fits': largest[encoding] <= limit} for model, limit, encoding in MODELS],
+    }
+    return manifest
+
+def write_manifest(kind, manifest, out_dir=None):
+    """Skriv {kind}.manifest.json; Returns: sökvägen"""
+    path = Path(out_dir or project_root()) / MANIFEST_PATTERN.format(kind)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return path
+
+def remove_manifest(kind, out_dir=None):
+    """Ta bort ett gammalt {kind}.manifest.json, vars offset inte längre stämmer med det nya paketet"""
+    try:
+        (Path(out_dir or project_root()) / MANIFEST_PATTERN.format(kind)).unlink()
+    except FileNotFoundError:
+        pass
+
+def _symbol_sections(file_path, rel_path, names, with_tokens):
+    """Symbolintervall delas aldrig upp och komprimeras inte, så radnumren stämmer med promptpack -n"""
+    try:
+        with PROFILER.phase('create_code_file.read', trace=False):
+            texts, missing = symbol_texts(file_path, names)
+    except Exception as e:
+        note = f"# Error reading file: {e}\n"
+        yield rel_path, note, None, _estimate_tokens(note), None
+        return
+    for line_range, text in texts:
+        tokens = count_tokens_cached(text) if with_tokens else None
+        yield f"{rel_path}:{line_range}", text, None, tokens, None
+    if missing:
+        note = f"# Symbols not found: {', '.join(missing)}\n"
+        yield rel_path, note, None, _estimate_tokens(note), None
+
+def _section_header(rel_path, line_map, line_range=None):
+    header = f"\n### ./{rel_path}\n"
+    if line_range:
+        header += f"[lines {line_range[0]}-{line_range[1]} of {line_range[2]}]\n"
+        if line_map and line_map[-1] - line_map[0] == len(line_map) - 1:
+            line_map = None
+    if line_map:
+        formatted = format_line_map(line_map)
+        if formatted:
+            header += f"[line map: {formatted}]\n"
+    return header + "\n"
+
+def _part_header(number, count, entries):
+    if number == 1:
+        intro = (f"# Part 1 of {count}\n"
+                 f"This package is split into {count} parts. Read all of them before answering.\n"
+                 f"A file that continues in the next part repeats its ### header with a [lines a-b of n] note.\n")
+    else:
+        intro = (f"# Part {number} of {count}\n"
+                 f"Continuation of the package; the instructions and project structure are in part 1.\n")
+    return intro + "## Contents\n" + ''.join(f"- {entry}\n" for entry in entries) + "\n"
+
+def _split_section(rel_path, content, line_map, tokens, total_lines, first_room, room):
+    """Dela en för stor fil vid radgränser; tokens per del skattas proportionellt mot tecknen"""
+    # Bara '\n' räknas som radslut, precis som i _line_count, line_map och -n
+    lines = LINE_PATTERN.findall(content)
+    ratio = tokens / max(1, len(content))
+    pieces = []
+    start = 0
+    budget = first_room
+    while start < len(lines):
+        end = start
+        used = 0
+        while end < len(lines):
+            cost = int(len(lines[end]) * ratio) + 1
+            if end > start and used + cost > budget:
+                break
+            used += cost
+            end += 1
+        piece_map = line_map[start:end] if line_map else None
+        first_line = piece_map[0] if piece_map else start + 1
+        last_line = piece_map[-1] if piece_map else end
+        pieces.append((rel_path, ''.join(lines[start:end]), piece_map, used, (first_line, last_line, total_lines)))
+        start = end
+        budget = room
+    return pieces
+
+@profiled('write_code_parts')
+def write_code_parts(preamble, sections, budget, entries=None, out_dir=None):
+    """
+    Skriv code.part1.txt, code.part2.txt, ... i out_dir där varje del ryms i budget tokens
+    Filer hålls hela när de får plats, annars delas de vid radgränser; ryms allt i en del blir det vanlig code.txt
+    entries (lista) fylls med manifestposter per sektion
+    Returns: (list of (filename, tokens, sections), tom om code.txt skrevs; PackageWriter-summeringar per fil)
+    """
+    out_dir = Path(out_dir or project_root())
+    overhead = _estimate_tokens(_part_header(1, 999, ["Instructions and project structure"]))
+    parts = [[]]
+    used = overhead + count_tokens_cached(preamble)
+    
+    def cost(piece):
+        header = _section_header(piece[0], piece[2], piece[4])
+        return piece[3] + _estimate_tokens(header) * 2
+    
+    for rel_path, content, line_map, tokens, total_lines in sections:
+        piece = (rel_path, content, line_map, tokens, None)
+        if used + cost(piece) <= budget:
+            parts[-1].append(piece)
+            used += cost(piece)
+            continue
+        if cost(piece) <= budget - overhead or total_lines is None:
+            parts.append([piece])
+            used = overhead + cost(piece)
+            continue
+        
+        # Oversized: use what is left of this part if it is worth it, then full parts
+        room = budget - overhead - 2 * _estimate_tokens(_section_header(rel_path, None, (total_lines,) * 3))
+        first_room = room - (used - overhead)
+        if first_room < room // 4:
+            parts.append([])
+            used = overhead
+            first_room = room
+        for index, piece in enumerate(_split_section(rel_path, content, line_map, tokens, total_lines, first_room, room)):
+            if index:
+                parts.append([])
+                used = overhead
+            parts[-1].append(piece)
+            used += cost(piece)
+    
+    for stale in out_dir.glob(CODE_PART_PATTERN.format('*')):
+        stale.unlink()
+    
+    if len(parts) == 1:
+        with open(out_dir / 'code.txt', 'w', encoding='utf-8') as out:
+            writer = PackageWriter(out, 'code.txt', entries)
+            writer.write(preamble)
+            for rel_path, content, line_map, _, _ in parts[0]:
+                writer.section(rel_path, _section_header(rel_path, line_map), content)
+        return [], [writer.summary()]
+    
+    # En gammal code.txt bredvid delarna skulle se ut som ett aktuellt paket
+    stale_code = out_dir / 'code.txt'
+    if stale_code.exists():
+        stale_code.unlink()
+    
+    written = []
+    summaries = []
+    count = len(parts)
+    for number, pieces in enumerate(parts, start=1):
+        entries = []
+        for rel_path, _, _, _, line_range in pieces:
+            entry = f"./{rel_path}"
+            if line_range:
+                entry += f" (lines {line_range[0]}-{line_range[1]} of {line_range[2]})"
+            entries.append(entry)
+        if number == 1:
+            entries.insert(0, "Instructions and project structure")
+        filename = CODE_PART_PATTERN.format(number)
+        with open(out_dir / filename, 'w', encoding='utf-8') as out:
+            writer = PackageWriter(out, filename, entries)
+            header = _part_header(number, count, entries)
+            writer.write(header)
+            tokens = _estimate_tokens(header)
+            if number == 1:
+                writer.write(preamble)
+                tokens += count_tokens_cached(preamble)
+            for rel_path, content, line_map, piece_tokens, line_range in pieces:
+                section_header = _section_header(rel_path, line_map, line_range)
+                writer.section(rel_path, section_header, content, line_range)
+                tokens += piece_tokens + _estimate_tokens(section_header)
+        written.append((filename, tokens, len(pieces)))
+        summaries.append(writer.summary())
+    return written, summaries
 
-def create_ctags_file(root):
+@profiled('create_ctags_file')
+def create_ctags_file(root, manifest=False, out_dir=None):
     marked_files = get_marked_files(root)
     
     if not marked_files:
@@ -934,8 +3525,12 @@ def create_ctags_file(root):
     
     marked_files = sorted(marked_files, key=lambda x: str(x))
     
-    with open('ctags.txt', 'w', encoding='utf-8') as out:
-        out.write("""These are all the files of the project listed with Universal Ctags.
+    out_dir = Path(out_dir) if out_dir else project_root()
+    entries = [] if manifest else None
+    with open(out_dir / 'ctags.txt', 'w', encoding='utf-8') as out:
+        writer = PackageWriter(out, 'ctags.txt', entries)
+        preamble = io.StringIO()
+        preamble.write("""These are all the files of the project listed with Universal Ctags.
 Understand the user request, what files are available and what they contain.
 Draw conclusions what you need from the project to achieve the users goals.
 Once you know what files you need, let the user prepare the package of files for you.
@@ -954,34 +3549,418 @@ If you for some reason later on find you need additional files from the project,
 """)
 
                 
-        write_project_tree(out, root)
+        write_project_tree(preamble, root)
+        writer.write(preamble.getvalue())
         for file_path in marked_files:
             try:
-                rel_path = file_path.relative_to(Path.cwd())
-                result = subprocess.run(
-                    ['ctags', '-x', str(rel_path)],
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
+                rel_path = file_path.relative_to(project_root())
+                PROFILER.count(subprocess=1, files=1)
+                with PROFILER.phase('ctags', trace=False):
+                    result = subprocess.run(
+                        ['ctags', '-x', str(rel_path)],
+                        capture_output=True,
+                        text=True,
+                        check=True,
+                        cwd=project_root()
+                    )
                 if result.stdout:
-                    out.write(f"\n### {rel_path}\n")
+                    listing = []
                     for line in result.stdout.splitlines():
                         parts = line.split(None, 4)
                         if len(parts) >= 5:
-                            out.write(
+                            listing.append(
                                 f"{parts[0]}\t{parts[1]}\t{parts[2]}\t{parts[4]}\n"
                             )
+                    writer.section(rel_path, f"\n### {rel_path}\n", ''.join(listing))
 
             except subprocess.CalledProcessError:
                 pass
             except Exception as e:
-                out.write(f"\n### {file_path.relative_to(Path.cwd())}\n")
-                out.write(f"# Error running ctags: {e}\n")
+                writer.section(file_path.relative_to(project_root()), f"\n### {file_path.relative_to(project_root())}\n",
+                               f"# Error running ctags: {e}\n")
+    if manifest:
+        write_manifest('ctags', build_manifest([writer.summary()], entries), out_dir)
+    else:
+        remove_manifest('ctags', out_dir)
     
     return True
 
-def main(stdscr):
+def print_compaction_report(report):
+    """Skriv ut sparade tokens per komprimerad fil"""
+    if not report:
+        return
+    saved_total = sum(before - after for _, before, after in report)
+    print(f"\nCompaction saved {saved_total:,} tokens:")
+    for rel_path, before, after in sorted(report, key=lambda r: r[2] - r[1]):
+        if before > after:
+            print(f"{before - after:>9,}\t{(before - after) / before * 100:5.1f}%\t{rel_path}")
+
+def print_truncation_report(truncated):
+    """Skriv ut vilka filer som kortades av --cap"""
+    if not truncated:
+        return
+    print(f"\nTruncated {len(truncated)} file(s) to their cap:")
+    for rel_path, first, last, total in truncated:
+        print(f"{last - first + 1:>9,} of {total:,} lines omitted\t{rel_path}")
+
+def print_code_summary(filename, file_count, compact_report=None, manifest=False):
+    """Storlek och fyllnadsgrad per modell; filen läses en gång och varje kodning körs en gång"""
+    with PROFILER.phase('token_summary'):
+        with open(filename, 'r', encoding='utf-8') as f:
+            content = f.read()
+        PROFILER.count(files=1, bytes_read=len(content))
+        counts = count_tokens_multi(content)
+    total_tokens = counts[DEFAULT_ENCODING]
+    
+    print(f"✅ {filename} created!")
+    print(f"\nIncluded {file_count} files")
+    print(f"File size: {len(content):,} bytes")
+    print(f"Tokensize: {total_tokens:,} tokens")
+    print(f"\nModel capacity:")
+    
+    for model, max_tokens, encoding in MODELS:
+        tokens = counts[encoding]
+        pct = (tokens / max_tokens) * 100
+        status = '✅' if tokens <= max_tokens else '🔴'
+        detail = f" ({tokens:,} tokens)" if tokens != total_tokens else ""
+        print(f"{status} {pct:5.1f}%\t{model}{detail}")
+    
+    print_compaction_report(compact_report)
+    if manifest:
+        print(f"\n🧾 Manifest: {MANIFEST_PATTERN.format(Path(filename).stem)}")
+
+def print_stream_summary(target, file_count, summary):
+    """Sammanfattning för --output utifrån det som räknades medan paketet skrevs, utan att läsa tillbaka"""
+    tokens = summary['files'][0]['tokens']
+    total_tokens = tokens.get(DEFAULT_ENCODING, 0)
+    print(f"✅ Streamed package to {'stdout' if target == '-' else target}")
+    print(f"\nIncluded {file_count} files")
+    print(f"Package size: {summary['totals']['bytes']:,} bytes (uncompressed)")
+    print(f"Tokensize: {total_tokens:,} tokens")
+    print(f"\nModel capacity:")
+    for model in summary['models']:
+        pct = (model['tokens'] / model['limit']) * 100
+        status = '✅' if model['fits'] else '🔴'
+        detail = f" ({model['tokens']:,} tokens)" if model['tokens'] != total_tokens else ""
+        print(f"{status} {pct:5.1f}%\t{model['name']}{detail}")
+
+def print_roots_summary(trees):
+    """Filer och tokens per rot vid flera rötter; tokens kommer ur den delade cachen"""
+    print(f"\nRoots:")
+    for tree in trees:
+        marked_files = get_marked_files(tree)
+        symbol_marks = get_symbol_marks(tree)
+        tokens = calculate_total_tokens(marked_files) + symbol_selection_tokens(symbol_marks)
+        print(f"📁 {len(marked_files) + len(symbol_marks):>5} files\t{tokens:>9,} tokens\t./{root_label(tree.path)}")
+
+def print_parts_summary(parts, file_count, budget, manifest=False):
+    """Sammanfattning för uppdelad utdata; tokens kommer från de cachade räkningarna"""
+    print(f"✅ {len(parts)} part(s) created, max {budget:,} tokens each")
+    print(f"\nIncluded {file_count} files")
+    for filename, tokens, sections in parts:
+        status = '✅' if tokens <= budget else '🔴'
+        print(f"{status} {filename}\t{tokens:>9,} tokens\t{sections} section(s)")
+    if manifest:
+        print(f"\n🧾 Manifest: {MANIFEST_PATTERN.format('code')}")
+
+def reveal_node(root, node):
+    """Fäll ut föräldrarna till node och returnera dess rad i trädvyn"""
+    parent = node.parent
+    while parent is not None:
+        parent.expanded = True
+        parent = parent.parent
+    for idx, (visible, _) in enumerate(flatten_visible_tree(root)):
+        if visible is node:
+            return idx
+    return 0
+
+def show_file_finder(stdscr, root):
+    """
+    Snabbsökning: filtrera filer medan man skriver, Space markerar direkt
+    Returns: vald TreeNode (Enter) eller None (Esc)
+    """
+    index = getattr(root, 'path_index', None) or PathIndex(root)
+    root.path_index = index
+    base = root.path
+    query = ""
+    selected = 0
+    scroll = 0
+    results = index.search(query, limit=FINDER_LIMIT)
+    
+    while True:
+        stdscr.erase()
+        height, width = stdscr.getmaxyx()
+        display_height = max(1, height - 2)
+        selected = max(0, min(selected, len(results) - 1))
+        if selected < scroll:
+            scroll = selected
+        elif selected >= scroll + display_height:
+            scroll = selected - display_height + 1
+        
+        try:
+            stdscr.addstr(0, 0, f"Find: {query}".ljust(width-1)[:width-1], curses.A_REVERSE)
+        except curses.error:
+            pass
+        for i, node in enumerate(results[scroll:scroll + display_height]):
+            mark = "[✓] " if node.marked else "[ ] "
+            attr = curses.A_REVERSE if scroll + i == selected else curses.A_NORMAL
+            try:
+                stdscr.addstr(i + 1, 0, mark, (curses.color_pair(1) if node.marked else curses.A_NORMAL) | (attr & curses.A_REVERSE))
+                name_attr = attr | curses.A_BOLD if node.marked else attr
+                stdscr.addstr(i + 1, len(mark), str(node.path.relative_to(base))[:width - len(mark) - 1], name_attr)
+            except curses.error:
+                pass
+        
+        marked_files = get_marked_files(root)
+        status = f"{index.match_count:,} matches | Marked: {len(marked_files)} | Space: Mark | Enter: Show in tree | Esc: Back"
+        try:
+            stdscr.addstr(height - 1, 0, status.ljust(width-1)[:width-1], curses.A_REVERSE)
+        except curses.error:
+            pass
+        stdscr.refresh()
+        
+        key = stdscr.get_wch() if hasattr(stdscr, 'get_wch') else stdscr.getch()
+        if key in ('\x1b', 27):
+            return None
+        elif key in ('\n', '\r', curses.KEY_ENTER, 10, 13):
+            return results[selected] if results else None
+        elif key == curses.KEY_UP:
+            selected -= 1
+        elif key == curses.KEY_DOWN:
+            selected += 1
+        elif key == curses.KEY_PPAGE:
+            selected -= display_height
+        elif key == curses.KEY_NPAGE:
+            selected += display_height
+        elif key in (' ', 32):
+            if results:
+                results[selected].toggle_mark()
+                save_selection(root)
+        elif key in (curses.KEY_BACKSPACE, '\x7f', '\b', 127, 8):
+            if query:
+                query = query[:-1]
+                results = index.search(query, limit=FINDER_LIMIT)
+                selected = 0
+        elif isinstance(key, str) and key.isprintable():
+            query += key
+            results = index.search(query, limit=FINDER_LIMIT)
+            selected = 0
+        elif isinstance(key, int) and 32 < key < 127:
+            query += chr(key)
+            results = index.search(query, limit=FINDER_LIMIT)
+            selected = 0
+
+class _TreeScreen:
+    """Låter _read_prompt rita om trädvyn med prompten i statusraden"""
+    def __init__(self, root, selected_idx, scroll_offset):
+        self.root = root
+        self.selected_idx = selected_idx
+        self.scroll_offset = scroll_offset
+    
+    def draw(self, stdscr, prompt=None):
+        draw_tree(stdscr, self.root, self.selected_idx, self.scroll_offset, prompt=prompt)
+
+def select_by_content(stdscr, root, selected_idx, scroll_offset):
+    """Markera alla filer vars innehåll matchar en regex; visar antal och tokens innan något markeras"""
+    screen = _TreeScreen(root, selected_idx, scroll_offset)
+    pattern = _read_prompt(stdscr, screen, "Grep (regex): ")
+    if not pattern:
+        return
+    
+    screen.draw(stdscr, prompt=f"Scanning for {pattern}...")
+    try:
+        hits = grep_tree(root, pattern)
+    except re.error as e:
+        screen.draw(stdscr, prompt=f"❌ Invalid pattern: {e} | Press any key")
+        stdscr.getch()
+        return
+    if not hits:
+        screen.draw(stdscr, prompt=f"No files match {pattern} | Press any key")
+        stdscr.getch()
+        return
+    _confirm_marks(stdscr, screen, root, hits, f"{len(hits)} file(s) match")
+
+def select_dependencies(stdscr, root, selected_idx, scroll_offset):
+    """Markera lokala importer (transitivt) till de markerade filerna efter bekräftelse"""
+    screen = _TreeScreen(root, selected_idx, scroll_offset)
+    marked_files = get_marked_files(root)
+    if not marked_files:
+        screen.draw(stdscr, prompt="Mark some files first | Press any key")
+        stdscr.getch()
+        return
+    screen.draw(stdscr, prompt="Resolving imports...")
+    added = expand_imports(root, marked_files)
+    if not added:
+        screen.draw(stdscr, prompt="No unmarked local imports | Press any key")
+        stdscr.getch()
+        return
+    _confirm_marks(stdscr, screen, root, added, f"{len(added)} imported file(s)")
+
+def select_changed(stdscr, root, selected_idx, scroll_offset):
+    """Markera filer som ändrats enligt git: oincheckade, eller sedan en angiven ref"""
+    screen = _TreeScreen(root, selected_idx, scroll_offset)
+    since = _read_prompt(stdscr, screen, "Changed since ref (empty: uncommitted): ")
+    if since is None:
+        return
+    changed = git_changed_files(root.path, since.strip() or None)
+    if changed is None:
+        screen.draw(stdscr, prompt=f"❌ Not a git repository or unknown ref {since} | Press any key")
+        stdscr.getch()
+        return
+    nodes = [node for node in get_file_nodes(root) if node.path in changed]
+    if not nodes:
+        screen.draw(stdscr, prompt="No changed text files | Press any key")
+        stdscr.getch()
+        return
+    _confirm_marks(stdscr, screen, root, nodes, f"{len(nodes)} changed file(s)")
+
+def _confirm_marks(stdscr, screen, root, nodes, label):
+    """Visa antal och tokens före/efter; Enter markerar nodes"""
+    marked_files = get_marked_files(root)
+    before = calculate_total_tokens(marked_files)
+    new = [node for node in nodes if not node.marked]
+    after = before + calculate_total_tokens([node.path for node in new])
+    screen.draw(stdscr, prompt=f"{label}, {len(new)} new | "
+                               f"Tokensize: {before:,} → {after:,} | Enter: Mark all | Esc: Cancel")
+    key = stdscr.getch()
+    if key in (curses.KEY_ENTER, 10, 13):
+        for node in new:
+            node.marked = True
+            node.symbol_marks = set()
+        save_selection(root)
+
+class BackgroundWork:
+    """
+    Bakgrundstrådar för TUI:n: tokenräkning i daemontrådar och sparning av markeringar i en egen tråd
+    Räkningarna kommer tillbaka via en resultatkö som UI-tråden tömmer med poll(), så inmatningen aldrig väntar
+    """
+    def __init__(self, workers=None):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.known = {}
+        self.pending = set()
+        self._saver = ThreadPoolExecutor(max_workers=1)
+        self._generation = 0
+        self._saved = None
+        # Daemontrådar: avslutar man mitt i en räkning väntar programmet inte på dem
+        for _ in range(workers or min(4, os.cpu_count() or 1)):
+            threading.Thread(target=self._count_loop, daemon=True).start()
+    
+    def tokens(self, key, func):
+        """
+        Känt antal, eller None medan func räknas i bakgrunden
+        Räkningen gäller filens mtime/storlek; ändras filen (F12, g, d, c eller utanför TUI:n) räknas den om
+        """
+        path = key[0] if isinstance(key, tuple) else key
+        try:
+            st = Path(path).stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        known = self.known.get(key)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        if (key, stamp) not in self.pending:
+            self.pending.add((key, stamp))
+            self.jobs.put(((key, stamp), func))
+        return None
+    
+    def _count_loop(self):
+        while True:
+            key, func = self.jobs.get()
+            try:
+                tokens = func()
+            except Exception:
+                tokens = 0
+            self.results.put((key, tokens))
+    
+    def poll(self):
+        """Hämta färdiga räkningar; Returns: True om något nytt kom"""
+        changed = False
+        while True:
+            try:
+                key, tokens = self.results.get_nowait()
+            except queue.Empty:
+                return changed
+            self.pending.discard(key)
+            key, stamp = key
+            self.known[key] = (stamp, tokens)
+            changed = True
+    
+    def status(self, root):
+        """Statusraden; filer som inte är räknade än skattas från storleken och markeras med ~"""
+        nodes = [node for node in get_file_nodes(root) if node.marked]
+        symbol_marks = get_symbol_marks(root)
+        total = 0
+        waiting = 0
+        for node in nodes:
+            tokens = self.tokens(node.path, functools.partial(file_tokens, node.path))
+            if tokens is None:
+                waiting += 1
+                tokens = node.size // 4
+            total += tokens
+        for path, names in symbol_marks.items():
+            tokens = self.tokens((path, frozenset(names)), functools.partial(symbol_selection_tokens, {path: names}))
+            if tokens is None:
+                waiting += 1
+                tokens = 0
+            total += tokens
+        
+        status = f"Marked: {len(nodes)} files"
+        if symbol_marks:
+            status += f", {sum(len(names) for names in symbol_marks.values())} symbols"
+        if waiting:
+            jobs = len(nodes) + len(symbol_marks)
+            return f"{status} | Tokensize: ~{total:,} (counting {jobs - waiting}/{jobs})"
+        return f"{status} | Tokensize: {total:,} tokens"
+    
+    def save(self, root):
+        """Spara markeringarna i bakgrunden; bara den senaste ögonblicksbilden skrivs"""
+        self._generation += 1
+        self._saved = self._saver.submit(self._save_snapshot, self._generation,
+                                         get_marked_files(root), get_symbol_marks(root))
+    
+    def _save_snapshot(self, generation, marked_files, symbol_marks):
+        if generation == self._generation:
+            save_promptpack(marked_files, symbol_marks)
+    
+    def flush(self):
+        """Vänta in en pågående sparning, så att inget synkront sparande skrivs över av en äldre bild"""
+        if self._saved is not None:
+            self._saved.result()
+            self._saved = None
+
+def scan_tree(stdscr):
+    """
+    Bygg trädet i en bakgrundstråd och visa hur många poster som lästs; q avbryter
+    Returns: TreeNode eller None
+    """
+    progress = collections.Counter()
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(root=build_tree(".", with_index=True, progress=progress)),
+                              daemon=True)
+    worker.start()
+    worker.join(SCAN_GRACE)
+    
+    stdscr.timeout(POLL_MS)
+    try:
+        while worker.is_alive():
+            stdscr.erase()
+            height, width = stdscr.getmaxyx()
+            message = f"Scanning project… {progress['entries']:,} entries | q: Quit"
+            try:
+                stdscr.addstr(height - 1, 0, message.ljust(width - 1)[:width - 1], curses.A_REVERSE)
+            except curses.error:
+                pass
+            stdscr.refresh()
+            if stdscr.getch() in (ord('q'), ord('Q')):
+                return None
+    finally:
+        stdscr.timeout(-1)
+    return result.get('root')
+
+def main(stdscr, compact=False, compact_report=None, split_tokens=None, code_parts=None, manifest=False,
+         caps=None, truncated=None):
     curses.curs_set(0)
     stdscr.keypad(True)
     
@@ -990,12 +3969,14 @@ def main(stdscr):
     curses.init_pair(1, curses.COLOR_GREEN, -1)
     curses.init_pair(2, curses.COLOR_YELLOW, -1)
     
-    root = build_tree(".")
+    root = scan_tree(stdscr)
     if not root:
         return None
     
+    work = BackgroundWork()
     selected_idx = 0
     scroll_offset = 0
+    dirty = True
     
     while True:
         height, width = stdscr.getmaxyx()
@@ -1007,30 +3988,51 @@ def main(stdscr):
         elif selected_idx >= scroll_offset + display_height:
             scroll_offset = selected_idx - display_height + 1
         
-        draw_tree(stdscr, root, selected_idx, scroll_offset)
+        if work.poll() or dirty:
+            draw_tree(stdscr, root, selected_idx, scroll_offset, status=work.status(root))
+            dirty = False
+        stdscr.timeout(POLL_MS)
         key = stdscr.getch()
-        
+        stdscr.timeout(-1)
+        if key == -1:
+            continue
+        dirty = True
+        if key not in (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_LEFT, curses.KEY_RIGHT, ord(' ')):
+            work.flush()
 
         if key == ord('q') or key == ord('Q'):
             return None
         elif key == curses.KEY_F1:  # F1 för code.txt
             marked_files = get_marked_files(root)
-            if marked_files:
-                save_promptpack(marked_files)
-                create_code_file(root)
-                return ('code', len(marked_files))
+            symbol_marks = get_symbol_marks(root)
+            if marked_files or symbol_marks:
+                save_selection(root)
+                create_code_file(root, compact=compact, report=compact_report,
+                                 split_tokens=split_tokens, parts=code_parts, manifest=manifest,
+                                 caps=caps, truncated=truncated)
+                return ('code', len(marked_files) + len(symbol_marks))
             else:
                 return ('code', 0)
         elif key == curses.KEY_F2:  # F2 för ctags.txt
             marked_files = get_marked_files(root)
             if marked_files:
                 save_promptpack(marked_files)
-                create_ctags_file(root)
+                create_ctags_file(root, manifest=manifest)
                 return ('ctags', len(marked_files))
             else:
                 return ('ctags', 0)
         elif key == curses.KEY_F12:
             show_patch_history(stdscr)
+        elif key == ord('g'):
+            select_by_content(stdscr, root, selected_idx, scroll_offset)
+        elif key == ord('d'):
+            select_dependencies(stdscr, root, selected_idx, scroll_offset)
+        elif key == ord('c'):
+            select_changed(stdscr, root, selected_idx, scroll_offset)
+        elif key == ord('/'):
+            node = show_file_finder(stdscr, root)
+            if node is not None:
+                selected_idx = reveal_node(root, node)
         elif key == curses.KEY_UP:
             selected_idx = max(0, selected_idx - 1)
         elif key == curses.KEY_DOWN:
@@ -1040,25 +4042,213 @@ def main(stdscr):
                 node, _ = visible_nodes[selected_idx]
                 if node.is_dir and not node.expanded:
                     node.toggle_expand()
+                elif not node.is_dir and not node.expanded and not isinstance(node, SymbolNode):
+                    expand_symbols(node)
         elif key == curses.KEY_LEFT:
             if selected_idx < len(visible_nodes):
                 node, _ = visible_nodes[selected_idx]
-                if node.is_dir and node.expanded:
-                    node.toggle_expand()
+                if isinstance(node, SymbolNode):
+                    node = node.parent
+                    selected_idx = next(i for i, (visible, _) in enumerate(visible_nodes) if visible is node)
+                if node.expanded:
+                    node.expanded = False
         elif key == ord(' '):
             if selected_idx < len(visible_nodes):
                 node, _ = visible_nodes[selected_idx]
                 node.toggle_mark()
-                marked_files = get_marked_files(root)
-                save_promptpack(marked_files)
+                work.save(root)
+
+# Biblioteks-API: explicit projektrot, strukturerade resultat, inga utskrifter eller sys.exit.
+# Varje anrop kör i project(root) för sin tråd, så olika rötter kan packas parallellt;
+# kodningar, tokencachen och cachefilerna delas mellan anropen.
+
+def _api_paths(root_path, paths):
+    """Sökvägar relativt root_path (eller absoluta) som absoluta Path; ValueError om någon ligger utanför"""
+    resolved = []
+    for path in paths:
+        full = (root_path / path).resolve()
+        if not str(full).startswith(f"{root_path}{os.sep}"):
+            raise ValueError(f"Path outside project root: {path}")
+        resolved.append(full)
+    return resolved
+
+def _model_fit(counts):
+    return [{'name': model, 'limit': limit, 'encoding': encoding, 'tokens': counts.get(encoding, 0),
+             'fits': counts.get(encoding, 0) <= limit} for model, limit, encoding in MODELS]
+
+def pack(root, files=None, symbols=None, compact=False, split_tokens=None, caps=None, manifest=False,
+         out_dir=None, deps=None, budget=None, git=None):
+    """
+    Packa filer i projektet root till code.txt (eller code.partN.txt) i out_dir, standard root
+    files: sökvägar relativt root; symbols: {sökväg: [namn]}; båda None = projektets urval i ~/.promptpack
+    caps: gränser som för --cap ('8000', '*.min.js=16KB' eller parse_cap-tupler); deps/budget som --deps/--budget
+    Returns: dict med manifestets fält (files, sections, totals, models) plus ok, outputs, parts, added,
+             truncated och compaction; eller {'ok': False, 'error': ...}
+    """
+    root_path = Path(root).resolve()
+    try:
+        caps = [parse_cap(cap) if isinstance(cap, str) else cap for cap in caps or []]
+        with project(root_path):
+            tree = build_tree(root_path, load_marks=files is None and symbols is None, git=git)
+            if tree is None:
+                return {'ok': False, 'error': f"Project root not found: {root}"}
+            if out_dir:
+                out_dir = Path(out_dir).resolve()
+                out_dir.mkdir(parents=True, exist_ok=True)
+            else:
+                out_dir = root_path
+            if files is not None:
+                mark_from_promptpack(tree, set(_api_paths(root_path, files)))
+            if symbols:
+                mark_symbols(tree, {path: set(names) for path, names
+                                    in zip(_api_paths(root_path, symbols), symbols.values())})
+            added = []
+            if deps is not None:
+                added = expand_imports(tree, get_marked_files(tree), deps or None, budget)
+                for node in added:
+                    node.marked = True
+            
+            compaction, truncated, parts, summary = [], [], [], {}
+            if not create_code_file(tree, compact=compact, report=compaction, split_tokens=split_tokens, parts=parts,
+                                    manifest=manifest, caps=caps, truncated=truncated, summary=summary,
+                                    out_dir=out_dir):
+                return {'ok': False, 'error': "No files selected"}
+    except (OSError, ValueError, argparse.ArgumentTypeError) as e:
+        return {'ok': False, 'error': str(e)}
+    
+    outputs = [out_dir / name for name, _, _ in parts] or [out_dir / 'code.txt']
+    if manifest:
+        outputs.append(out_dir / MANIFEST_PATTERN.format('code'))
+    return dict(summary, ok=True,
+                outputs=[str(path) for path in outputs],
+                parts=[{'name': name, 'tokens': tokens, 'sections': sections} for name, tokens, sections in parts],
+                added=[str(node.path.relative_to(root_path)) for node in added],
+                truncated=[{'path': str(rel_path), 'omitted': [first, last], 'lines': total}
+                           for rel_path, first, last, total in truncated],
+                compaction=[{'path': str(rel_path), 'before': before, 'after': after}
+                            for rel_path, before, after in compaction])
+
+def count(root, files=None, symbols=None):
+    """
+    Tokens per fil (och per symbolurval) för alla kodningar i MODELS, utan att skriva något
+    Returns: dict med ok, files (path, bytes, tokens per kodning eller error), tokens (summa) och models
+    """
+    root_path = Path(root).resolve()
+    encodings = _manifest_encodings()
+    with project(root_path):
+        if files is None and symbols is None:
+            paths = sorted(load_promptpack())
+            symbols = load_promptpack_symbols()
+        else:
+            try:
+                paths = _api_paths(root_path, files or [])
+                symbols = dict(zip(_api_paths(root_path, symbols or {}), (symbols or {}).values()))
+            except ValueError as e:
+                return {'ok': False, 'error': str(e)}
+    
+    entries = []
+    totals = collections.Counter()
+    for path in paths:
+        entry = {'path': str(path.relative_to(root_path))}
+        try:
+            content, digest = read_text_hashed(path)
+            entry['bytes'] = len(content.encode('utf-8'))
+            entry['tokens'] = {encoding: count_tokens_cached(content, digest, encoding) for encoding in encodings}
+            totals.update(entry['tokens'])
+        except (OSError, UnicodeDecodeError) as e:
+            entry['error'] = str(e)
+        entries.append(entry)
+    for path, names in symbols.items():
+        entry = {'path': str(path.relative_to(root_path)), 'symbols': sorted(names)}
+        try:
+            texts, missing = symbol_texts(path, set(names))
+            text = ''.join(text for _, text in texts)
+            entry['bytes'] = len(text.encode('utf-8'))
+            entry['tokens'] = {encoding: count_tokens_cached(text, encoding=encoding) for encoding in encodings}
+            if missing:
+                entry['missing'] = missing
+            totals.update(entry['tokens'])
+        except (OSError, UnicodeDecodeError) as e:
+            entry['error'] = str(e)
+        entries.append(entry)
+    return {'ok': all('error' not in entry for entry in entries), 'files': entries,
+            'tokens': totals[DEFAULT_ENCODING], 'models': _model_fit(totals)}
+
+def patch(root, path, description, old_text, new_text):
+    """
+    Applicera en patch i projektet root (som -p, men utan clipboard.tmp)
+    Returns: dict med ok, message, patch_id och path
+    """
+    root_path = Path(root).resolve()
+    with project(root_path):
+        try:
+            filepath, = _api_paths(root_path, [path])
+        except ValueError as e:
+            return {'ok': False, 'message': str(e), 'patch_id': None, 'path': str(path)}
+        success, message, patch_id = patch_file(filepath, description, old_text, new_text)
+    return {'ok': success, 'message': message, 'patch_id': patch_id, 'path': str(filepath.relative_to(root_path))}
+
+def read(root, path, lines=None):
+    """
+    Läs en fil i projektet root, hela eller lines=(start, end) med samma justering som -n
+    Returns: dict med ok, path, text, start, end och total (antal rader), eller ok=False och error
+    """
+    root_path = Path(root).resolve()
+    try:
+        filepath, = _api_paths(root_path, [path])
+        rel_path = str(filepath.relative_to(root_path))
+        if lines:
+            start, end, total, text = read_line_range(filepath, *lines)
+            if text is None or start > end:
+                return {'ok': False, 'path': rel_path, 'error': f"Invalid range {start},{end} (file has {total} lines)"}
+        else:
+            text, _ = read_text_hashed(filepath)
+            start, end = 1, _line_count(text)
+            total = end
+    except (OSError, ValueError) as e:
+        return {'ok': False, 'path': str(path), 'error': str(e)}
+    return {'ok': True, 'path': rel_path, 'text': text, 'start': start, 'end': end, 'total': total}
+
+def ctags(root, files=None):
+    """
+    Symboltabeller (namn, sort, start- och slutrad) från Universal Ctags, cachade på mtime
+    Returns: dict med ok och files: {relativ sökväg: [{'name', 'kind', 'start', 'end'}]}
+    """
+    root_path = Path(root).resolve()
+    if shutil.which('ctags') is None:
+        return {'ok': False, 'error': "ctags not found"}
+    with project(root_path):
+        try:
+            paths = sorted(load_promptpack()) if files is None else _api_paths(root_path, files)
+        except ValueError as e:
+            return {'ok': False, 'error': str(e)}
+    result = {}
+    for path in paths:
+        result[str(path.relative_to(root_path))] = [
+            {'name': name, 'kind': kind, 'start': start, 'end': end}
+            for name, kind, start, end in file_symbols(path)]
+    SYMBOL_CACHE.save()
+    return {'ok': True, 'files': result}
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Interactive directory navigator')
     parser.add_argument('-q', '--quick', action='store_true', 
                         help='Create code.txt directly from .promptpack without interactive mode')
+    parser.add_argument('--roots', nargs='+', metavar='DIR',
+                        help='Pack the .promptpack selections of several project roots into one code.txt with root-prefixed paths')
     parser.add_argument('-a', '--add', nargs='+', metavar='FILE',
-                        help='Add specified files to .promptpack and create code.txt')
+                        help='Add specified files (or single symbols as FILE::Name) to .promptpack and create code.txt')
 
+    parser.add_argument('-g', '--grep', metavar='REGEX',
+                        help='Add every text file whose content matches REGEX to .promptpack and create code.txt')
+    parser.add_argument('--changed', nargs='?', const='', metavar='REF',
+                        help='Add files with uncommitted changes (or changed since REF) to .promptpack and create code.txt')
+    parser.add_argument('--git', action='store_true',
+                        help='List files from the git index instead of walking the directory (ignored files are left out)')
+    parser.add_argument('--deps', nargs='?', type=int, const=0, metavar='DEPTH',
+                        help='With -q, -a or -g: also include local imports of the selection, transitively or DEPTH levels deep')
+    parser.add_argument('--budget', type=int, metavar='TOKENS',
+                        help='With --deps: stop adding imports once the selection would exceed TOKENS')
     parser.add_argument('-p', '--patch', nargs=2, metavar=('FILE', 'DESC'),
                         help='Apply patch reading old/new text from stdin (format: OLD_TEXT\n---SPLIT---\nNEW_TEXT)')
     parser.add_argument('-r', '--read', metavar='FILE',
@@ -1067,38 +4257,106 @@ if __name__ == "__main__":
                         help='Read specific lines (e.g., 10,20) and copy to clipboard')
     parser.add_argument('-c', '--clear', action='store_true',
                         help='Copy clipboard.tmp to clipboard and remove the file')
+    parser.add_argument('--check', nargs='?', const='-', metavar='FILE',
+                        help='Dry-run a bash block of promptpack -p commands (stdin or FILE) and print a JSON report')
+    parser.add_argument('--reset', nargs='?', const='code', metavar='SINCE',
+                        help='Revert all applied patches since a patch id, an ISO timestamp or the last code.txt (default)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='With --reset, --grep or --changed: only report what would be reverted or selected')
+    parser.add_argument('--gc', action='store_true',
+                        help='Remove undo snapshots no longer referenced by patch.json')
+    parser.add_argument('--sink', metavar='SINK',
+                        help='Where -c sends the collected output: clipboard (default), stdout, osc52 or file:PATH')
+    parser.add_argument('--profile', nargs='?', const='summary', metavar='OUT',
+                        help='Record per-phase timings: summary (default), FILE.json or FILE.trace.json (Chrome trace)')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='Save a cProfile capture of the hottest phase to FILE')
+    parser.add_argument('--split', type=int, metavar='TOKENS',
+                        help='Write code.part1.txt, code.part2.txt, ... that each fit in TOKENS instead of one code.txt')
+    parser.add_argument('--compact', action='store_true',
+                        help='Strip license headers, comment banners and redundant whitespace from code.txt')
+    parser.add_argument('--cap', action='append', type=parse_cap, metavar='[GLOB=]LIMIT',
+                        help='Truncate files over LIMIT tokens (or bytes: 64KB, 2M) to head + tail; repeat with GLOB= per pattern')
+    parser.add_argument('-o', '--output', metavar='TARGET',
+                        help="Stream the package to TARGET instead of code.txt: '-' for stdout, a file or a named pipe")
+    parser.add_argument('--compress', choices=list(OUTPUT_COMPRESSION),
+                        help='Compress --output (default: by file extension .gz, .bz2, .xz or .zst)')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Also write code.manifest.json / ctags.manifest.json with byte offsets, hashes and tokens per section')
     args = parser.parse_args()
+    compact_report = []
+    code_parts = []
+    truncated = []
+    stream_summary = {} if args.output else None
+    
+    if args.output:
+        if not (args.quick or args.add or args.grep or args.changed is not None or args.roots):
+            parser.error("--output needs -q, -a, -g, --changed or --roots")
+        if args.split:
+            parser.error("--split writes several files and cannot be combined with --output")
+        if output_compression(args.output, args.compress) == 'zstd' and zstd is None:
+            parser.error("zstd needs Python 3.14 (compression.zstd); use gzip, bz2 or xz")
+        if args.output == '-':
+            # Paketet går till fd 1 via open_output; allt annat som skrivs ut hamnar på stderr
+            sys.stdout = sys.stderr
+    
+    if args.profile or args.cprofile:
+        PROFILER.configure(args.profile or os.environ.get(PROFILE_ENV), args.cprofile)
     
     if args.clear:
-        if CLIPBOARD_TMP_FILE.exists():
-            if copy_clipboard_tmp_to_clipboard():
+        sink = get_sink(args.sink)
+        if sink is None:
+            print(f"❌ Unknown sink: {args.sink or os.environ.get(SINK_ENV)} (use clipboard, stdout, osc52 or file:PATH)")
+            sys.exit(1)
+        with file_lock(CLIPBOARD_TMP_FILE):
+            if CLIPBOARD_TMP_FILE.exists():
+                if flush_clipboard_tmp(sink):
 
-                try:
-                    CLIPBOARD_TMP_FILE.unlink()
-                    sys.exit(0)
-                except Exception as e:
-                    print(f"✅ File copied but could not remove: {e}")
-                    sys.exit(0)
+                    try:
+                        CLIPBOARD_TMP_FILE.unlink()
+                        sys.exit(0)
+                    except Exception as e:
+                        print(f"✅ File copied but could not remove: {e}")
+                        sys.exit(0)
+                else:
+                    print(f"❌ {sink.error}")
+                    sys.exit(1)
             else:
-                print("❌ Could not copy to clipboard (install xclip, xsel, or pbcopy)")
+                print("❌ clipboard.tmp not found")
                 sys.exit(1)
+    
+    if args.check:
+        if args.check == '-':
+            block = sys.stdin.read()
         else:
-            print("❌ clipboard.tmp not found")
-            sys.exit(1)
+            with open(args.check, 'r', encoding='utf-8') as f:
+                block = f.read()
+        report = check_patch_stream(block)
+        report_json = json.dumps(report, indent=2, ensure_ascii=False)
+        print(report_json)
+        append_to_clipboard_tmp(report_json)
+        sys.exit(0 if report['ok'] else 1)
+    
+    if args.reset:
+        success, messages = revert_patches(args.reset, dry_run=args.dry_run)
+        for message in messages:
+            print(message)
+        sys.exit(0 if success else 1)
+    
+    if args.gc:
+        removed, freed = gc_object_store()
+        print(f"✅ Removed {removed} unreferenced snapshot(s), freed {freed:,} bytes")
+        sys.exit(0)
     
     if args.read:
         success, message = read_file_to_clipboard(args.read)
         print(message)
-        if success and copy_clipboard_tmp_to_clipboard():
-            pass
         sys.exit(0 if success else 1)
     
     if args.lines:
         line_range, filepath = args.lines
         success, message = read_lines_to_clipboard(line_range, filepath)
         print(message)
-        if success and copy_clipboard_tmp_to_clipboard():
-            pass
         sys.exit(0 if success else 1)
     
     if args.patch:
@@ -1108,20 +4366,17 @@ if __name__ == "__main__":
         stdin_content = sys.stdin.read()
         
         # Split on ---SPLIT---
-        parts = stdin_content.split('---SPLIT---')
-        if len(parts) != 2:
+        parts = split_patch_input(stdin_content)
+        if parts is None:
             print(f"❌ [{filepath}] '{description}': Error: stdin must contain OLD_TEXT---SPLIT---NEW_TEXT")
             sys.exit(1)
         
-        old_text = parts[0]
-        new_text = parts[1]
+        old_text, new_text = parts
         
         success, message = apply_patch(filepath, description, old_text, new_text)
         
         if success:
             print(f"✅ {message}")
-            if copy_clipboard_tmp_to_clipboard():
-                pass
             sys.exit(0)
         else:
             print(f"❌ {message}")
@@ -1129,11 +4384,51 @@ if __name__ == "__main__":
     
     check_ctags()
     
-    if args.add:
+    if args.git:
+        GIT_ENUMERATION = True
+    
+    if args.add or args.grep or args.changed is not None:
         cwd = Path.cwd().resolve()
         new_files = set()
+        root = None
+        
+        if args.changed is not None:
+            changed = git_changed_files(cwd, args.changed or None)
+            if changed is None:
+                print(f"❌ Not a git repository or unknown ref: {args.changed}")
+                sys.exit(1)
+            changed = sorted(path for path in changed if str(path).startswith(f"{cwd}{os.sep}")
+                             and not any(part.startswith('.') for part in path.relative_to(cwd).parts)
+                             and is_text_file(path))
+            for path in changed:
+                print(f"   {path.relative_to(cwd)}")
+            print(f"🔀 {len(changed)} changed file(s){f' since {args.changed}' if args.changed else ''}")
+            if args.dry_run:
+                sys.exit(0 if changed else 1)
+            new_files.update(changed)
         
-        for file_str in args.add:
+        if args.grep:
+            root = build_tree(".", load_marks=False)
+            if not root:
+                print("❌ Could not read directory structure!")
+                sys.exit(1)
+            try:
+                hits = grep_tree(root, args.grep)
+            except re.error as e:
+                print(f"❌ Invalid pattern: {e}")
+                sys.exit(1)
+            
+            for node in hits:
+                print(f"   {node.path.relative_to(root.path)}")
+            hit_tokens = calculate_total_tokens([node.path for node in hits])
+            print(f"🔎 {len(hits)} file(s) match '{args.grep}' ({hit_tokens:,} tokens)")
+            if args.dry_run:
+                sys.exit(0 if hits else 1)
+            new_files.update(node.path.resolve() for node in hits)
+        
+        new_symbols = {}
+        for file_str in args.add or []:
+            file_str, sep, symbol = file_str.partition(SYMBOL_SEPARATOR)
             file_path = Path(file_str).resolve()
             if not file_path.exists():
                 print(f"❌ File not found: {file_str}")
@@ -1144,9 +4439,15 @@ if __name__ == "__main__":
             if not is_text_file(file_path):
                 print(f"❌ Not a text file: {file_str}")
                 continue
+            if sep:
+                if not any(_symbol_matches(name, {symbol}) for name, _, _, _ in file_symbols(file_path)):
+                    print(f"❌ Symbol not found: {file_str}{SYMBOL_SEPARATOR}{symbol}")
+                    continue
+                new_symbols.setdefault(file_path, set()).add(symbol)
+                continue
             new_files.add(file_path)
         
-        if not new_files:
+        if not new_files and not new_symbols:
             print("❌ No valid files to add!")
             sys.exit(1)
         
@@ -1156,65 +4457,111 @@ if __name__ == "__main__":
                 for line in f:
                     line = line.strip()
                     if line:
-                        path = Path(line)
+                        path_part, sep, name = line.partition(SYMBOL_SEPARATOR)
+                        path = Path(path_part)
                         if path.exists():
-                            existing_paths.add(path.resolve())
+                            existing_paths.add(f"{path.resolve()}{sep}{name}")
         
-        all_paths = existing_paths | new_files
+        all_paths = existing_paths | {str(path) for path in new_files}
+        all_paths |= {f"{path}{SYMBOL_SEPARATOR}{name}" for path, names in new_symbols.items() for name in names}
         with open(PROMPTPACK_FILE, 'w', encoding='utf-8') as f:
             for path in sorted(all_paths):
                 f.write(f"{path}\n")
         
-        print(f"✅ Added {len(new_files)} file(s) to .promptpack")
+        if new_files:
+            print(f"✅ Added {len(new_files)} file(s) to .promptpack")
+        if new_symbols:
+            print(f"✅ Added {sum(len(names) for names in new_symbols.values())} symbol(s) to .promptpack")
         
-        root = build_tree(".", load_marks=False)
+        if root is None:
+            root = build_tree(".", load_marks=False)
         if not root:
             print("❌ Could not read directory structure!")
             sys.exit(1)
         
         mark_from_promptpack(root, new_files)
-        marked_files = get_marked_files(root)
+        mark_symbols(root, new_symbols)
+        if args.deps is not None:
+            mark_dependencies(root, args.deps, args.budget)
+        marked_files = get_marked_files(root) + list(get_symbol_marks(root))
         
         if not marked_files:
             print("❌ No valid files found!")
             sys.exit(1)
         
-        create_code_file(root)
+        try:
+            create_code_file(root, compact=args.compact, report=compact_report,
+                             split_tokens=args.split, parts=code_parts, manifest=args.manifest,
+                             caps=args.cap, truncated=truncated, summary=stream_summary,
+                             output=args.output, compression=args.compress)
+        except OSError as e:
+            print(f"❌ Could not write {args.output or 'code.txt'}: {e}")
+            sys.exit(1)
+        if args.output:
+            print_stream_summary(args.output, len(marked_files), stream_summary)
+            print_compaction_report(compact_report)
+            print_truncation_report(truncated)
+            sys.exit(0)
+        if code_parts:
+            print_parts_summary(code_parts, len(marked_files), args.split, args.manifest)
+            print_compaction_report(compact_report)
+            print_truncation_report(truncated)
+            sys.exit(0)
         
         try:
-            with open('code.txt', 'r', encoding='utf-8') as f:
-                content = f.read()
-            total_tokens = calculate_tokens(content)
-            file_size = len(content)
-            
-            print(f"✅ code.txt created!")
-            print(f"\nIncluded {len(marked_files)} files")
-            print(f"File size: {file_size:,} bytes")
-            print(f"Tokensize: {total_tokens:,} tokens")
-            print(f"\nModel capacity:")
-            
-            models = {
-                'DeepSeek': 128000,
-                'Grok': 128000,
-                'GPT-4': 32768,
-                'GPT-5': 128000,
-                'Claude': 200000,
-                'Qwen': 128000
-            }
-            
-            for model, max_tokens in models.items():
-                pct = (total_tokens / max_tokens) * 100
-                status = '✅' if total_tokens <= max_tokens else '🔴'
-                print(f"{status} {pct:5.1f}%\t{model}")
+            print_code_summary('code.txt', len(marked_files), compact_report, args.manifest)
+            print_truncation_report(truncated)
                 
         except Exception as e:
             print(f"❌ Error reading code.txt: {e}")
             sys.exit(1)
     
+    elif args.roots:
+        roots = [Path(path).resolve() for path in args.roots]
+        missing = [path for path, root in zip(args.roots, roots) if not root.is_dir()]
+        if missing:
+            print(f"❌ Not a directory: {', '.join(missing)}")
+            sys.exit(1)
+        if len(set(roots)) != len(roots):
+            print("❌ The same root was given twice")
+            sys.exit(1)
+        
+        # Rubrikerna blir relativa föräldern som rötterna har gemensam, t.ex. ./billing/src/app.py
+        base = Path(os.path.commonpath([root.parent for root in roots]))
+        trees = build_trees(roots)
+        with project(base):
+            if args.deps is not None:
+                for tree in trees:
+                    mark_dependencies(tree, args.deps, args.budget)
+            
+            file_count = sum(len(get_marked_files(tree)) + len(get_symbol_marks(tree)) for tree in trees)
+            if not file_count:
+                print("❌ No files in .promptpack for these roots!")
+                sys.exit(1)
+            
+            try:
+                create_code_file(trees, compact=args.compact, report=compact_report,
+                                 split_tokens=args.split, parts=code_parts, manifest=args.manifest,
+                                 caps=args.cap, truncated=truncated, out_dir=Path.cwd(), summary=stream_summary,
+                                 output=args.output, compression=args.compress)
+            except OSError as e:
+                print(f"❌ Could not write {args.output or 'code.txt'}: {e}")
+                sys.exit(1)
+            if args.output:
+                print_stream_summary(args.output, file_count, stream_summary)
+            elif code_parts:
+                print_parts_summary(code_parts, file_count, args.split, args.manifest)
+            else:
+                print_code_summary('code.txt', file_count, None, args.manifest)
+            print_roots_summary(trees)
+            print_compaction_report(compact_report)
+            print_truncation_report(truncated)
+    
     elif args.quick:
         promptpack_paths = load_promptpack()
+        promptpack_symbols = load_promptpack_symbols()
         
-        if not promptpack_paths:
+        if not promptpack_paths and not promptpack_symbols:
             print("❌ No files in .promptpack!")
             sys.exit(1)
         
@@ -1224,79 +4571,59 @@ if __name__ == "__main__":
             sys.exit(1)
         
         mark_from_promptpack(root, promptpack_paths)
+        mark_symbols(root, promptpack_symbols)
+        if args.deps is not None:
+            mark_dependencies(root, args.deps, args.budget)
         
-        marked_files = get_marked_files(root)
+        marked_files = get_marked_files(root) + list(get_symbol_marks(root))
         if not marked_files:
             print("❌ No valid files found from .promptpack!")
             sys.exit(1)
         
-        create_code_file(root)
+        try:
+            create_code_file(root, compact=args.compact, report=compact_report,
+                             split_tokens=args.split, parts=code_parts, manifest=args.manifest,
+                             caps=args.cap, truncated=truncated, summary=stream_summary,
+                             output=args.output, compression=args.compress)
+        except OSError as e:
+            print(f"❌ Could not write {args.output or 'code.txt'}: {e}")
+            sys.exit(1)
+        if args.output:
+            print_stream_summary(args.output, len(marked_files), stream_summary)
+            print_compaction_report(compact_report)
+            print_truncation_report(truncated)
+            sys.exit(0)
+        if code_parts:
+            print_parts_summary(code_parts, len(marked_files), args.split, args.manifest)
+            print_compaction_report(compact_report)
+            print_truncation_report(truncated)
+            sys.exit(0)
         
         try:
-            with open('code.txt', 'r', encoding='utf-8') as f:
-                content = f.read()
-            total_tokens = calculate_tokens(content)
-            file_size = len(content)
-            
-            print(f"✅ code.txt created!")
-            print(f"\nIncluded {len(marked_files)} files")
-            print(f"File size: {file_size:,} bytes")
-            print(f"Tokensize: {total_tokens:,} tokens")
-            print(f"\nModel capacity:")
-            
-            models = {
-                'DeepSeek': 128000,
-                'Grok': 128000,
-                'GPT-4': 32768,
-                'GPT-5': 128000,
-                'Claude': 200000,
-                'Qwen': 128000
-            }
-            
-            for model, max_tokens in models.items():
-                pct = (total_tokens / max_tokens) * 100
-                status = '✅' if total_tokens <= max_tokens else '🔴'
-                print(f"{status} {pct:5.1f}%\t{model}")
+            print_code_summary('code.txt', len(marked_files), compact_report, args.manifest)
+            print_truncation_report(truncated)
                 
         except Exception as e:
             print(f"❌ Error reading code.txt: {e}")
             sys.exit(1)
     else:
-        result = curses.wrapper(main)
+        result = curses.wrapper(main, args.compact, compact_report, args.split, code_parts, args.manifest,
+                                args.cap, truncated)
         
         if result is not None:
             file_type, file_count = result
             
             if file_count == 0:
                 print("❌ No files marked!")
+            elif file_type == 'code' and code_parts:
+                print_parts_summary(code_parts, file_count, args.split, args.manifest)
+                print_compaction_report(compact_report)
+                print_truncation_report(truncated)
             else:
                 filename = f"{file_type}.txt"
                 try:
-                    with open(filename, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    file_size = len(content)
-                    total_tokens = calculate_tokens(content)
-                    
-                    print(f"✅ {filename} created!")
-                    print(f"\nIncluded {file_count} files")
-                    print(f"File size: {file_size:,} bytes")
-                    print(f"Tokensize: {total_tokens:,} tokens")
-                    print(f"\nModel capacity:")
-                    
-                    models = {
-                        'DeepSeek': 128000,
-                        'Grok': 128000,
-                        'GPT-4': 32768,
-                        'GPT-5': 128000,
-                        'Claude': 200000,
-                        'Qwen': 128000
-                    }
-                    
-                    for model, max_tokens in models.items():
-                        pct = (total_tokens / max_tokens) * 100
-                        status = '✅' if total_tokens <= max_tokens else '🔴'
-                        print(f"{status} {pct:5.1f}%\t{model}")
+                    print_code_summary(filename, file_count, compact_report, args.manifest)
+                    print_truncation_report(truncated)
                         
                 except Exception as e:
                     print(f"❌ Error reading {filename}: {e}")